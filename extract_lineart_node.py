@@ -4,10 +4,12 @@ Extract Line Art Node for ComfyUI
 """
 
 import torch
+import torch.nn.functional as F
 import numpy as np
 from PIL import Image, ImageFilter
 import folder_paths
 import os
+from functools import lru_cache
 
 comfy_path = os.path.dirname(folder_paths.__file__)
 fixableflow_path = f'{comfy_path}/custom_nodes/ComfyUI-FixableFlow'
@@ -64,39 +66,55 @@ def extract_lineart(image):
     return result
 
 
-def tensor_to_pil(tensor):
+def tensor_to_uint8(tensor):
     """
-    ComfyUIのテンソル形式をPIL Imageに変換
+    ComfyUIのテンソル形式を同じデバイス上のuint8テンソルに変換（バッチ全体を保持）
     """
     # tensor shape: [batch, height, width, channels]
-    image_np = tensor.cpu().detach().numpy()
-    if len(image_np.shape) == 4:
-        image_np = image_np[0]  # バッチの最初の画像を取得
-    image_np = (image_np * 255).astype(np.uint8)
-    
-    # チャンネル数に応じてモードを選択
-    if image_np.shape[2] == 3:
-        mode = 'RGB'
-    elif image_np.shape[2] == 4:
-        mode = 'RGBA'
-    else:
-        mode = 'L'
-    
-    return Image.fromarray(image_np, mode=mode)
+    tensor = tensor.detach()
+    if tensor.dim() == 3:
+        tensor = tensor.unsqueeze(0)  # バッチ次元を追加
+    # NumPyの astype(np.uint8) と同じく切り捨てで量子化
+    return (tensor * 255).to(torch.uint8)
 
 
-def pil_to_tensor(image):
+def uint8_to_tensor(image):
     """
-    PIL ImageをComfyUIのテンソル形式に変換
+    uint8テンソルをComfyUIのテンソル形式（float32, 0-1）に変換
     """
-    # RGBAをnumpy配列に変換
-    image_np = np.array(image).astype(np.float32) / 255.0
-    
-    # バッチ次元を追加
-    image_np = np.expand_dims(image_np, axis=0)
-    
-    # テンソルに変換
-    return torch.from_numpy(image_np)
+    return image.to(torch.float32) / 255.0
+
+
+def rgb_to_gray(image):
+    """
+    PILの convert('L') と同じ係数・丸めでグレースケールに変換
+    入力: [B, H, W, C] uint8
+    出力: [B, H, W] uint8
+    """
+    if image.shape[-1] < 3:
+        return image[..., 0].clone()
+    rgb = image[..., :3].to(torch.int32)
+    gray = (rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16
+    return gray.to(torch.uint8)
+
+
+def smooth_gray(gray):
+    """
+    ImageFilter.SMOOTH と同じ3x3カーネルをconv2dでバッチ全体に適用
+    PILと同様に画像の外周1ピクセルはそのまま残す
+    """
+    result = gray.clone()
+    if gray.shape[1] < 3 or gray.shape[2] < 3:
+        return result
+
+    kernel = torch.tensor([[1.0, 1.0, 1.0],
+                           [1.0, 5.0, 1.0],
+                           [1.0, 1.0, 1.0]], device=gray.device).view(1, 1, 3, 3)
+    total = F.conv2d(gray.unsqueeze(1).to(torch.float32), kernel).squeeze(1)
+    # floor(total / 13 + 0.5) を整数演算で計算（PILの丸めと一致）
+    smoothed = torch.div(total.to(torch.int32) + 6, 13, rounding_mode='floor')
+    result[:, 1:-1, 1:-1] = smoothed.to(torch.uint8)
+    return result
 
 
 class ExtractLineArtNode:
@@ -154,50 +172,33 @@ class ExtractLineArtNode:
             alpha_mask: アルファチャンネルのマスク
         """
         
-        # テンソルをPIL Imageに変換
-        pil_image = tensor_to_pil(image)
+        # 入力と同じデバイス上でuint8に変換（[B, H, W, C]、バッチ全体）
+        image_u8 = tensor_to_uint8(image)
         
         # グレースケールに変換
-        image_gray = pil_image.convert('L')
+        gray = rgb_to_gray(image_u8)
         
         # 白の閾値処理
-        gray_array = np.array(image_gray)
-        gray_array[gray_array > white_threshold] = 255
-        image_gray = Image.fromarray(gray_array)
+        gray[gray > white_threshold] = 255
         
         # スムージング適用
         if apply_smoothing:
-            image_gray = image_gray.filter(ImageFilter.SMOOTH)
-        
-        # RGBA画像を作成
-        gray_array = np.array(image_gray)
-        result_array = np.zeros((*gray_array.shape, 4), dtype=np.uint8)
+            gray = smooth_gray(gray)
         
         # アルファ値の設定
         if invert_alpha:
             # 白い部分を不透明に（通常の逆）
-            alpha_array = gray_array
+            alpha = gray
         else:
             # 黒い部分を不透明に（通常の線画処理）
-            alpha_array = 255 - gray_array
-        
-        # 線画の色設定（黒）
-        result_array[:, :, 0] = 0  # R
-        result_array[:, :, 1] = 0  # G  
-        result_array[:, :, 2] = 0  # B
-        result_array[:, :, 3] = alpha_array  # Alpha
+            alpha = 255 - gray
         
-        # PIL Imageに変換
-        result_image = Image.fromarray(result_array, mode='RGBA')
-        
-        # ComfyUIのテンソル形式に変換
-        output_tensor = pil_to_tensor(result_image)
+        # アルファマスク（[B, H, W]）
+        alpha_mask_tensor = uint8_to_tensor(alpha)
         
-        # アルファマスクを別途作成（グレースケール）
-        alpha_mask = alpha_array.astype(np.float32) / 255.0
-        alpha_mask = np.expand_dims(alpha_mask, axis=0)  # バッチ次元を追加
-        alpha_mask = np.expand_dims(alpha_mask, axis=-1)  # チャンネル次元を追加
-        alpha_mask_tensor = torch.from_numpy(alpha_mask)
+        # RGBA画像を作成（線画の色は黒）
+        output_tensor = torch.zeros((*alpha.shape, 4), dtype=torch.float32, device=alpha.device)
+        output_tensor[..., 3] = alpha_mask_tensor
         
         return (output_tensor, alpha_mask_tensor)
 
@@ -273,93 +274,89 @@ class ExtractLineArtAdvancedNode:
             alpha_mask: アルファマスク
         """
         
-        # テンソルをPIL Imageに変換
-        pil_image = tensor_to_pil(image)
-        original_image = pil_image.copy()
+        # 入力と同じデバイス上でuint8に変換（[B, H, W, C]、バッチ全体）
+        image_u8 = tensor_to_uint8(image)
         
         # グレースケール版を作成（アルファチャンネル計算用）
-        image_gray = pil_image.convert('L')
+        gray = rgb_to_gray(image_u8)
         
         if edge_detection:
-            # エッジ検出を使用する場合
+            # エッジ検出を使用する場合（CannyはCPU上で1枚ずつ処理）
             import cv2
-            gray_np = np.array(image_gray)
-            edges = cv2.Canny(gray_np, 50, 150)
-            gray_array = 255 - edges  # エッジを黒に
+            edges = np.stack([cv2.Canny(g, 50, 150) for g in gray.cpu().numpy()], axis=0)
+            gray = 255 - torch.from_numpy(edges).to(gray.device)  # エッジを黒に
         else:
             # 通常の閾値処理
-            gray_array = np.array(image_gray)
-            gray_array[gray_array > white_threshold] = 255
-        
-        image_gray = Image.fromarray(gray_array)
+            gray[gray > white_threshold] = 255
         
         # スムージング適用
         if apply_smoothing:
-            image_gray = image_gray.filter(ImageFilter.SMOOTH)
+            gray = smooth_gray(gray)
         
         # アルファ値の計算
-        gray_array = np.array(image_gray)
-        alpha_array = 255 - gray_array
+        alpha = 255 - gray
         
         # 線の濃さ調整
         if line_darkness != 1.0:
-            alpha_array = np.clip(alpha_array * line_darkness, 0, 255).astype(np.uint8)
+            # 元実装（NumPyのfloat64）と同じ丸めになるようfloat64で計算（MPSはfloat64非対応のためfloat32）
+            scale_dtype = torch.float32 if alpha.device.type == "mps" else torch.float64
+            alpha = (alpha.to(scale_dtype) * line_darkness).clamp(0, 255).to(torch.uint8)
         
         # RGBA画像を作成
-        result_array = np.zeros((*gray_array.shape, 4), dtype=np.uint8)
+        result = torch.zeros((*alpha.shape, 4), dtype=torch.uint8, device=alpha.device)
         
         if preserve_colors:
-            # 元の色を保持
-            original_array = np.array(original_image.convert('RGB'))
-            result_array[:, :, :3] = original_array
-        else:
-            # 黒い線画
-            result_array[:, :, 0] = 0  # R
-            result_array[:, :, 1] = 0  # G
-            result_array[:, :, 2] = 0  # B
-        
-        result_array[:, :, 3] = alpha_array  # Alpha
+            # 元の色を保持（グレースケール入力は3チャンネルに展開）
+            if image_u8.shape[-1] < 3:
+                result[..., :3] = image_u8[..., :1]
+            else:
+                result[..., :3] = image_u8[..., :3]
         
-        # PIL Imageに変換
-        result_image = Image.fromarray(result_array, mode='RGBA')
+        result[..., 3] = alpha  # Alpha
         
         # プレビュー画像の作成（チェッカーボード背景）
-        preview = create_preview_with_checkerboard(result_image)
+        preview = create_preview_with_checkerboard(result)
         
         # ComfyUIのテンソル形式に変換
-        output_tensor = pil_to_tensor(result_image)
-        preview_tensor = pil_to_tensor(preview)
+        output_tensor = uint8_to_tensor(result)
+        preview_tensor = uint8_to_tensor(preview)
         
-        # アルファマスクを作成
-        alpha_mask = alpha_array.astype(np.float32) / 255.0
-        alpha_mask = np.expand_dims(alpha_mask, axis=0)
-        alpha_mask = np.expand_dims(alpha_mask, axis=-1)
-        alpha_mask_tensor = torch.from_numpy(alpha_mask)
+        # アルファマスクを作成（[B, H, W]）
+        alpha_mask_tensor = uint8_to_tensor(alpha)
         
         return (output_tensor, preview_tensor, alpha_mask_tensor)
 
 
-def create_preview_with_checkerboard(rgba_image, tile_size=10):
+@lru_cache(maxsize=8)
+def checkerboard_tile(height, width, tile_size, device):
+    """
+    チェッカーボード背景（[H, W, 3] uint8）をブロードキャストで生成してキャッシュ
+    """
+    ys = torch.arange(height, device=device) // tile_size
+    xs = torch.arange(width, device=device) // tile_size
+    even = (ys[:, None] + xs[None, :]) % 2 == 0
+    board = torch.where(even, 255, 200).to(torch.uint8)
+    return board.unsqueeze(-1).expand(height, width, 3)
+
+
+def create_preview_with_checkerboard(rgba, tile_size=10):
     """
     チェッカーボード背景付きのプレビュー画像を作成
+    入力: [B, H, W, 4] uint8
+    出力: [B, H, W, 4] uint8（アルファは不透明）
     """
-    width, height = rgba_image.size
-    
-    # チェッカーボード背景を作成
-    checkerboard = Image.new('RGB', (width, height))
-    pixels = checkerboard.load()
-    
-    for y in range(height):
-        for x in range(width):
-            if (x // tile_size + y // tile_size) % 2 == 0:
-                pixels[x, y] = (255, 255, 255)
-            else:
-                pixels[x, y] = (200, 200, 200)
+    batch, height, width, _ = rgba.shape
+    board = checkerboard_tile(height, width, tile_size, rgba.device).to(torch.int32)
     
-    # RGBA画像をチェッカーボードの上に合成
-    checkerboard.paste(rgba_image, (0, 0), rgba_image)
+    # RGBA画像をチェッカーボードの上に合成（PILのpasteと同じ整数演算）
+    color = rgba[..., :3].to(torch.int32)
+    alpha = rgba[..., 3:].to(torch.int32)
+    tmp = board * (255 - alpha) + color * alpha + 128
+    blended = ((tmp >> 8) + tmp) >> 8
     
-    return checkerboard.convert('RGBA')
+    preview = torch.full((batch, height, width, 4), 255, dtype=torch.uint8, device=rgba.device)
+    preview[..., :3] = blended.to(torch.uint8)
+    return preview
 
 
 # ノードクラスのマッピングを更新
@@ -1,9 +1,9 @@
 import cv2
 import numpy as np
-import pandas as pd
-from sklearn.cluster import KMeans, MiniBatchKMeans
 
-from .ld_convertor import rgb2df, df2rgba
+from .ld_convertor import rgb2df
+from .ld_cluster import PaletteKMeans
+from .ld_cache import MaskCache, content_key
 
 # onnxruntimeはオプショナル（簡略化版では使用しない）
 try:
@@ -18,59 +18,238 @@ from PIL import Image
 
 
 import os
+import threading
+import time
+from collections import OrderedDict
 import urllib
 from functools import lru_cache
 from random import randint
 from typing import Any, Callable, Dict, List, Tuple
 
 
-# ONNXモデルの初期化（オプショナル）
-if ONNX_AVAILABLE:
+RMBG_REPO_ID = "skytnt/anime-seg"
+RMBG_FILENAME = "isnetis.onnx"
+
+# ONNXセッションの設定（configure_sessionで変更する）
+# providers: Noneなら利用可能なものから自動選択
+# intra_op_num_threads: 0ならonnxruntimeが物理コア数に合わせて並列化する
+# graph_optimization_level: "disable" / "basic" / "extended" / "all"
+# optimized_model_dir: 指定すると最適化済みモデルを保存し、次回以降はそれを読み込む
+session_config = {
+    "providers": None,
+    "intra_op_num_threads": 0,
+    "graph_optimization_level": "all",
+    "optimized_model_dir": None,
+}
+
+# プロセス全体で共有するセッション（初回のマスク取得時に生成）
+# 読み込みに失敗したモデルは SESSION_RETRY_SECONDS 経過後の取得時に読み込み直す
+SESSION_RETRY_SECONDS = 60.0
+_sessions = {}
+_session_failures = {}
+_session_lock = threading.Lock()
+
+
+def configure_session(**kwargs):
+    unknown = set(kwargs) - set(session_config)
+    if unknown:
+        raise ValueError(f"Unknown session option: {', '.join(sorted(unknown))}")
+    with _session_lock:
+        session_config.update(kwargs)
+        _sessions.clear()
+        _session_failures.clear()
+
+
+def get_model_dir():
+    try:
+        import folder_paths
+        return os.path.join(folder_paths.models_dir, "onnx")
+    except (ImportError, AttributeError):
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+
+
+def get_model_path(filename=RMBG_FILENAME, repo_id=RMBG_REPO_ID):
+    # ローカルのモデルフォルダを優先し、無ければHugging Faceから取得
+    local_path = os.path.join(get_model_dir(), filename)
+    if os.path.exists(local_path):
+        return local_path
+    import huggingface_hub
+    return huggingface_hub.hf_hub_download(repo_id, filename)
+
+
+def get_providers():
+    if session_config["providers"] is not None:
+        return list(session_config["providers"])
+    available = rt.get_available_providers()
+    return [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider") if p in available]
+
+
+def create_session(filename=RMBG_FILENAME, repo_id=RMBG_REPO_ID):
+    levels = {
+        "disable": rt.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": rt.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": rt.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all": rt.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }
+    options = rt.SessionOptions()
+    options.intra_op_num_threads = session_config["intra_op_num_threads"]
+    options.execution_mode = rt.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = levels[session_config["graph_optimization_level"]]
+
+    model_path = None
+    optimized_dir = session_config["optimized_model_dir"]
+    if optimized_dir:
+        optimized_path = os.path.join(optimized_dir, os.path.splitext(filename)[0] + ".opt.onnx")
+        if os.path.exists(optimized_path):
+            # 最適化済みモデルは再最適化しない
+            model_path = optimized_path
+            options.graph_optimization_level = rt.GraphOptimizationLevel.ORT_DISABLE_ALL
+        else:
+            os.makedirs(optimized_dir, exist_ok=True)
+            options.optimized_model_filepath = optimized_path
+    if model_path is None:
+        model_path = get_model_path(filename, repo_id)
+
+    return rt.InferenceSession(model_path, sess_options=options, providers=get_providers())
+
+
+def get_session(filename=RMBG_FILENAME, repo_id=RMBG_REPO_ID):
+    """背景除去モデルのセッションを取得（利用できない場合はNone）"""
+    if not ONNX_AVAILABLE:
+        return None
+    with _session_lock:
+        if filename in _sessions:
+            return _sessions[filename]
+        # 失敗は一時的なもの（ネットワークエラーなど）かもしれないので、キャッシュせず間を空けて再試行する
+        failed_at = _session_failures.get(filename)
+        if failed_at is not None and time.monotonic() - failed_at < SESSION_RETRY_SECONDS:
+            return None
+        try:
+            _sessions[filename] = create_session(filename, repo_id)
+        except Exception as e:
+            print(f"Warning: Could not load ONNX model: {e}")
+            _session_failures[filename] = time.monotonic()
+            return None
+        _session_failures.pop(filename, None)
+        return _sessions[filename]
+
+
+def letterbox_size(h, w, s):
+    return (s, int(s * w / h)) if h > w else (int(s * h / w), s)
+
+
+def get_bucket(h, w, s, buckets):
+    # 長辺が収まる最小のバケット（無ければ最大のバケット）
+    if not buckets:
+        return s
+    fits = [b for b in sorted(buckets) if b >= max(h, w)]
+    return fits[0] if fits else max(buckets)
+
+
+# 同じ画像のマスクを再計算しないためのキャッシュ
+mask_cache = MaskCache()
+
+
+# レターボックス入力バッファ（サイズごとに最大のバッチ数で確保し、先頭を切り出して再利用）
+# 推論中のバッファはプールから取り出しておき、ロックは出し入れの間だけ持つ
+# プールは合計 INPUT_BUFFER_POOL_BYTES までで、超えた分は使われていない古いサイズから解放する
+INPUT_BUFFER_POOL_BYTES = 256 * 1024 * 1024
+_input_buffers = OrderedDict()
+_buffer_lock = threading.Lock()
+
+
+def take_input_buffer(n, s):
+    with _buffer_lock:
+        buffer = _input_buffers.pop(s, None)
+    if buffer is None or buffer.shape[0] < n:
+        buffer = np.zeros([n, 3, s, s], dtype=np.float32)
+    return buffer
+
+
+def release_input_buffer(buffer):
+    s = buffer.shape[-1]
+    with _buffer_lock:
+        current = _input_buffers.get(s)
+        if current is None or current.shape[0] < buffer.shape[0]:
+            _input_buffers[s] = buffer
+        _input_buffers.move_to_end(s)
+        while sum(b.nbytes for b in _input_buffers.values()) > INPUT_BUFFER_POOL_BYTES:
+            _input_buffers.popitem(last=False)
+
+
+def run_letterbox(session, images, s):
+    """同じサイズのレターボックスに収めた画像をまとめて推論する"""
+    buffer = take_input_buffer(len(images), s)
     try:
-        import huggingface_hub
-        # Declare Execution Providers
-        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
-        # Download and host the model
-        model_path = huggingface_hub.hf_hub_download(
-            "skytnt/anime-seg", "isnetis.onnx")
-        rmbg_model = rt.InferenceSession(model_path, providers=providers)
-    except Exception as e:
-        print(f"Warning: Could not load ONNX model: {e}")
-        ONNX_AVAILABLE = False
-        rmbg_model = None
-else:
-    rmbg_model = None
+        img_input = buffer[:len(images)]
+        img_input.fill(0)
+
+        boxes = []
+        for i, img in enumerate(images):
+            img = (img[..., :3] / 255).astype(np.float32)
+            h, w = letterbox_size(*img.shape[:2], s)
+            ph, pw = s - h, s - w
+            img_input[i, :, ph // 2:ph // 2 + h, pw // 2:pw // 2 + w] = \
+                np.transpose(cv2.resize(img, (w, h)), (2, 0, 1))
+            boxes.append((ph // 2, pw // 2, h, w))
+
+        # IO bindingで入力バッファをそのまま渡す（セッションは複数スレッドから同時に実行できる）
+        binding = session.io_binding()
+        binding.bind_cpu_input(session.get_inputs()[0].name, img_input)
+        binding.bind_output(session.get_outputs()[0].name)
+        session.run_with_iobinding(binding)
+        output = binding.copy_outputs_to_cpu()[0]
+    finally:
+        release_input_buffer(buffer)
+
+    masks = []
+    for img, (top, left, h, w) in zip(images, boxes):
+        mask = np.transpose(output[len(masks)], (1, 2, 0))[top:top + h, left:left + w]
+        mask = cv2.resize(mask, (img.shape[1], img.shape[0]))[:, :, np.newaxis]
+        masks.append(mask)
+    return masks
+
+
+def get_masks(images, s=1024, buckets=None, use_cache=True):
+    """
+    複数画像のマスクをまとめて取得
+    buckets を指定すると長辺に応じたレターボックスサイズでグループ化し、
+    グループごとに1回の推論で処理する（未指定なら全て s で処理）
+    use_cache が有効なら、同じ画像・モデル・サイズのマスクはキャッシュから返す
+    """
+    rmbg_model = get_session()
+    if rmbg_model is None:
+        # ONNXが利用できない場合、全体を前景とする単純なマスクを返す
+        return [np.ones([img.shape[0], img.shape[1], 1], dtype=np.float32) for img in images]
+
+    # バッチ次元が固定のモデルは1枚ずつ推論する
+    batch_dim = rmbg_model.get_inputs()[0].shape[0]
+    max_batch = batch_dim if isinstance(batch_dim, int) and batch_dim > 0 else len(images)
+
+    masks = [None] * len(images)
+    keys = [None] * len(images)
+    groups = {}
+    for idx, img in enumerate(images):
+        size = get_bucket(img.shape[0], img.shape[1], s, buckets)
+        if use_cache:
+            keys[idx] = content_key(img, RMBG_FILENAME, size)
+            masks[idx] = mask_cache.get(keys[idx])
+            if masks[idx] is not None:
+                continue
+        groups.setdefault(size, []).append(idx)
+
+    for size, indices in groups.items():
+        for start in range(0, len(indices), max_batch):
+            chunk = indices[start:start + max_batch]
+            for idx, mask in zip(chunk, run_letterbox(rmbg_model, [images[i] for i in chunk], size)):
+                masks[idx] = mask_cache.put(keys[idx], mask) if use_cache else mask
+    return masks
+
 
 def get_mask(img, s=1024):
     """ONNXモデルを使用してマスクを取得（利用できない場合は単純なマスクを返す）"""
-    if not ONNX_AVAILABLE or rmbg_model is None:
-        # ONNXが利用できない場合、全体を前景とする単純なマスクを返す
-        h, w = img.shape[:-1]
-        return np.ones([h, w, 1], dtype=np.float32)
-    
-    img = (img / 255).astype(np.float32)
-    dim = img.shape[2]
-    if dim == 4:
-        img = img[..., :3]
-        dim = 3
-    h, w = h0, w0 = img.shape[:-1]
-    h, w = (s, int(s * w / h)) if h > w else (int(s * h / w), s)
-    ph, pw = s - h, s - w
-    img_input = np.zeros([s, s, dim], dtype=np.float32)
-    img_input[ph // 2:ph // 2 + h, pw //
-              2:pw // 2 + w] = cv2.resize(img, (w, h))
-    img_input = np.transpose(img_input, (2, 0, 1))
-    img_input = img_input[np.newaxis, :]
-    mask = rmbg_model.run(None, {'img': img_input})[0][0]
-    mask = np.transpose(mask, (1, 2, 0))
-    mask = mask[ph // 2:ph // 2 + h, pw // 2:pw // 2 + w]
-    mask = cv2.resize(mask, (w0, h0))[:, :, np.newaxis]
-    return mask
-
-def assign_tile(row, tile_width, tile_height):
-    tile_x = row['x_l'] // tile_width
-    tile_y = row['y_l'] // tile_height
-    return f"tile_{tile_y}_{tile_x}"
+    return get_masks([img], s)[0]
+
 
 def rmbg_fn(img):
     mask = get_mask(img)
@@ -89,33 +268,26 @@ def get_foreground(img, h_split, v_split, n_cluster, alpha, th_rate):
     image_height = img.shape[0]             
     mask = get_mask(img)
     mask = (mask * 255).astype(np.uint8)
-    mask = mask.repeat(3, axis=2)
 
     num_horizontal_splits = h_split
     num_vertical_splits = v_split
-    tile_width = image_width // num_horizontal_splits
-    tile_height = image_height // num_vertical_splits
-
-    df['tile'] = df.apply(assign_tile, args=(tile_width, tile_height), axis=1)
-
-    cls = MiniBatchKMeans(n_clusters=n_cluster, batch_size=100)
-    cls.fit(df[["r","g","b"]])
-    df["label"] = cls.labels_
+    tile_width = max(image_width // num_horizontal_splits, 1)
+    tile_height = max(image_height // num_vertical_splits, 1)
 
-    mask_df = rgb2df(mask)
-    mask_df['bg_label'] = (mask_df['r'] > alpha) & (mask_df['g'] > alpha) & (mask_df['b'] > alpha)
+    # タイル番号を座標から整数で計算（x_lは行、y_lは列の座標）
+    tile_x = df["x_l"].astype(np.int64) // tile_width
+    tile_y = df["y_l"].astype(np.int64) // tile_height
+    num_tile_x = (image_height - 1) // tile_width + 1
+    num_tile_y = (image_width - 1) // tile_height + 1
+    tile = tile_y * num_tile_x + tile_x
 
-    img_df = df.copy()
-    img_df["bg_label"] = mask_df["bg_label"]
-    img_df["label"] = img_df["label"].astype(str) + "-" + img_df["tile"]
-    bg_rate = img_df.groupby("label").sum()["bg_label"]/img_df.groupby("label").count()["bg_label"]
-    img_df['bg_cls'] = (img_df['label'].isin(bg_rate[bg_rate > th_rate].index)).astype(int)
-    img_df["a"] = 255
-    #img_df.loc[img_df['bg_cls'] == 0, ['a']] = 0
-    #img_df.loc[img_df['bg_cls'] != 0, ['a']] = 255
-    #img = df2rgba(img_df)
+    cls = PaletteKMeans(n_clusters=n_cluster, batch_size=100)
+    label = cls.fit_predict(df[["r","g","b"]]) * (num_tile_x * num_tile_y) + tile
 
-    bg_df = img_df[img_df["bg_cls"] == 0]
-    fg_df = img_df[img_df["bg_cls"] != 0] 
+    # (クラスタ, タイル) ごとの背景画素数と画素数を1回のbincountで集計
+    bg_label = mask[:, :, 0].ravel() > alpha
+    counts = np.bincount(label * 2 + bg_label, minlength=2 * (label.max() + 1)).reshape(-1, 2)
+    bg_rate = counts[:, 1] / np.maximum(counts.sum(axis=1), 1)
+    bg_cls = bg_rate[label] > th_rate
 
-    return [fg_df, bg_df]
+    return [bg_cls, ~bg_cls]
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def content_key(array, *extra):
+    # 配列の内容・形状・型と追加情報（モデル名など）からキーを作る
+    array = np.ascontiguousarray(array)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((array.shape, array.dtype.str, extra)).encode())
+    h.update(memoryview(array).cast("B"))
+    return h.hexdigest()
+
+
+class MaskCache:
+    """
+    画像内容のハッシュをキーにしたマスクのLRUキャッシュ
+
+    メモリ上の合計サイズが max_bytes を超えると古いものから破棄する。
+    spill_dir を指定すると破棄したマスクを .npy として保存し、次回はそこから読み込む。
+    保存したファイルの合計が max_spill_bytes を超えると古いものから削除する
+    （読み込んだマスクはメモリに戻るのでファイルは消し、再び破棄されたときに保存し直す）。
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, spill_dir=None, max_spill_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._spilled = OrderedDict()
+        self._spilled_bytes = 0
+        self._lock = threading.Lock()
+        if spill_dir is not None and os.path.isdir(spill_dir):
+            # 前回までに保存したファイルも古い順に上限の対象にする
+            files = sorted((entry for entry in os.scandir(spill_dir) if entry.name.endswith(".npy")),
+                           key=lambda entry: entry.stat().st_mtime)
+            for entry in files:
+                self._spilled[entry.name[:-len(".npy")]] = entry.stat().st_size
+                self._spilled_bytes += entry.stat().st_size
+            self._trim_spilled()
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, f"{key}.npy")
+
+    def _store(self, key, value):
+        if key in self._spilled:
+            self._remove_spilled(key)
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key).nbytes
+        self._entries[key] = value
+        self._bytes += value.nbytes
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            old_key, old_value = self._entries.popitem(last=False)
+            self._bytes -= old_value.nbytes
+            if self.spill_dir is not None:
+                self._spill(old_key, old_value)
+
+    def _spill(self, key, value):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = self._spill_path(key)
+        np.save(path, value)
+        self._spilled[key] = os.path.getsize(path)
+        self._spilled_bytes += self._spilled[key]
+        self._trim_spilled()
+
+    def _remove_spilled(self, key):
+        self._spilled_bytes -= self._spilled.pop(key)
+        try:
+            os.remove(self._spill_path(key))
+        except OSError:
+            pass
+
+    def _trim_spilled(self):
+        while self._spilled_bytes > self.max_spill_bytes and self._spilled:
+            self._remove_spilled(next(iter(self._spilled)))
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            if key in self._spilled:
+                value = np.load(self._spill_path(key))
+                value.setflags(write=False)
+                self._store(key, value)
+                self.hits += 1
+                return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        # キャッシュした配列を書き換えられないよう読み取り専用にする
+        value = np.array(value)
+        value.setflags(write=False)
+        with self._lock:
+            self._store(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self._entries), "bytes": self._bytes}
@@ -0,0 +1,107 @@
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+
+def stratified_sample(pixels, n_samples, seed=0):
+    # 画素をラスター順に n_samples 個の区間へ等分し、各区間から1画素ずつランダムに選ぶ
+    n = len(pixels)
+    if n_samples <= 0 or n <= n_samples:
+        return pixels
+    rng = np.random.default_rng(seed)
+    idx = ((np.arange(n_samples) + rng.random(n_samples)) * (n / n_samples)).astype(np.int64)
+    return pixels[np.minimum(idx, n - 1)]
+
+
+def quantize_colors(pixels, bins=32):
+    # RGBを bins^3 個の色ヒストグラムのビン番号に変換する
+    q = np.clip(np.asarray(pixels), 0, 255).astype(np.int64) // (256 // bins)
+    return (q[:, 0] * bins + q[:, 1]) * bins + q[:, 2]
+
+
+def color_histogram(pixels, bins=32):
+    # ビンごとの画素数と平均色（空のビンは除く）
+    codes = quantize_colors(pixels, bins)
+    counts = np.bincount(codes, minlength=bins ** 3)
+    occupied = np.flatnonzero(counts)
+    sums = np.stack([np.bincount(codes, weights=pixels[:, c], minlength=bins ** 3)[occupied]
+                     for c in range(3)], axis=1)
+    return occupied, sums / counts[occupied, None], counts[occupied]
+
+
+def kmeans_torch(points, weights, n_clusters, seed=0, max_iter=100, device='cpu'):
+    # 重み付きk-means（k-means++初期化 + Lloyd法）をtorchで実行する
+    import torch
+
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.as_tensor(points, dtype=torch.float32, device=device)
+    w = torch.as_tensor(weights, dtype=torch.float32, device=device)
+
+    first = torch.multinomial(w.cpu(), 1, generator=generator).item()
+    centers = x[[first]]
+    dist = ((x - centers) ** 2).sum(dim=1)
+    for _ in range(1, n_clusters):
+        prob = (dist * w).cpu()
+        if prob.sum() <= 0:
+            prob = w.cpu()
+        nxt = torch.multinomial(prob, 1, generator=generator).item()
+        centers = torch.cat([centers, x[[nxt]]])
+        dist = torch.minimum(dist, ((x - x[nxt]) ** 2).sum(dim=1))
+
+    for _ in range(max_iter):
+        labels = torch.cdist(x, centers).argmin(dim=1)
+        mass = torch.zeros(n_clusters, device=device).index_add_(0, labels, w)
+        sums = torch.zeros_like(centers).index_add_(0, labels, x * w[:, None])
+        updated = torch.where(mass[:, None] > 0, sums / mass.clamp(min=1e-12)[:, None], centers)
+        if torch.allclose(updated, centers, atol=1e-3):
+            centers = updated
+            break
+        centers = updated
+    return centers.cpu().numpy()
+
+
+class PaletteKMeans:
+    """
+    ldivider共通のカラークラスタリング
+
+    画素を層化サンプリングした上で 32^3 の色ヒストグラム（重み付きコアセット）に
+    まとめてからk-meansを行うため、学習コストは解像度にほぼ依存しない。
+    predict はビンごとの最近傍クラスタを引く変換表で全画素にラベルを付ける。
+    device を指定するとtorchのk-meansを使用する。
+    """
+
+    def __init__(self, n_clusters, n_samples=-1, bins=32, seed=0, device=None, batch_size=1024):
+        self.n_clusters = n_clusters
+        self.n_samples = n_samples
+        self.bins = bins
+        self.seed = seed
+        self.device = device
+        self.batch_size = batch_size
+        self.cluster_centers_ = None
+
+    def fit(self, pixels):
+        pixels = stratified_sample(np.asarray(pixels, dtype=np.float32).reshape(-1, 3), self.n_samples, self.seed)
+        _, points, weights = color_histogram(pixels, self.bins)
+        n_clusters = min(self.n_clusters, len(points))
+
+        if self.device is not None:
+            self.cluster_centers_ = kmeans_torch(points, weights, n_clusters, seed=self.seed, device=self.device)
+        else:
+            kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=self.batch_size, random_state=self.seed)
+            kmeans.fit(points, sample_weight=weights)
+            self.cluster_centers_ = kmeans.cluster_centers_
+        return self
+
+    def palette_lut(self, occupied, bin_means):
+        lut = np.zeros(self.bins ** 3, dtype=np.int64)
+        dist = ((bin_means[:, None, :] - self.cluster_centers_[None, :, :]) ** 2).sum(axis=2)
+        lut[occupied] = dist.argmin(axis=1)
+        return lut
+
+    def predict(self, pixels):
+        pixels = np.asarray(pixels, dtype=np.float32).reshape(-1, 3)
+        occupied, bin_means, _ = color_histogram(pixels, self.bins)
+        lut = self.palette_lut(occupied, bin_means)
+        return lut[quantize_colors(pixels, self.bins)]
+
+    def fit_predict(self, pixels):
+        return self.fit(pixels).predict(pixels)
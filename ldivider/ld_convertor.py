@@ -1,5 +1,4 @@
 import cv2
-import pandas as pd
 from sklearn.cluster import KMeans
 import numpy as np
 from skimage import color
@@ -10,83 +9,122 @@ def skimage_rgb2lab(rgb):
     return color.rgb2lab(rgb.reshape(1, 1, 3))
 
 
-def rgb2df(img):
-    h, w, _ = img.shape
-    x_l, y_l = np.meshgrid(np.arange(h), np.arange(w), indexing='ij')
-    r, g, b = img[:, :, 0], img[:, :, 1], img[:, :, 2]
-    df = pd.DataFrame({
-        "x_l": x_l.ravel(),
-        "y_l": y_l.ravel(),
-        "r": r.ravel(),
-        "g": g.ravel(),
-        "b": b.ravel(),
-    })
-    return df
+class PixelTable:
+    """
+    1ピクセル1行の表をDataFrame風の列アクセスで扱う配列ベースのコンテナ
+
+    色などの列は連続した [C, H, W] のNumPy平面として保持し、ラベルは別の
+    [H, W] 平面として持つ。table["r"] は平面をflattenしたビューを返すため、
+    列演算はコピーなしでNumPy演算として書ける。
+    """
+
+    def __init__(self, planes, columns, label=None, rows=None):
+        planes = np.asarray(planes)
+        self.height, self.width = planes.shape[1:]
+        self.columns = list(columns)
+        self._data = np.ascontiguousarray(planes, dtype=np.float32)
+        self._label = None
+        self.rows = rows
+        if label is not None:
+            self["label"] = label
+
+    @classmethod
+    def from_image(cls, img, columns):
+        return cls(np.moveaxis(img[:, :, :len(columns)], 2, 0), columns)
+
+    def __len__(self):
+        return self.height * self.width
+
+    def __contains__(self, key):
+        return key in self.columns or key in ("x_l", "y_l") or (key == "label" and self._label is not None)
+
+    def _plane(self, key):
+        if key in self.columns:
+            return self._data[self.columns.index(key)]
+        if key == "label" and self._label is not None:
+            return self._label
+        if key == "x_l":
+            return np.broadcast_to(np.arange(self.height)[:, np.newaxis], (self.height, self.width))
+        if key == "y_l":
+            return np.broadcast_to(np.arange(self.width)[np.newaxis, :], (self.height, self.width))
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            return np.stack([self[k] for k in key], axis=1)
+        return self._plane(key).reshape(-1)
+
+    def _as_plane(self, value):
+        value = np.asarray(value)
+        if value.size == len(self):
+            return value.reshape(self.height, self.width)
+        return np.broadcast_to(value, (self.height, self.width))
+
+    def __setitem__(self, key, value):
+        if key == "label":
+            self._label = np.array(self._as_plane(value))
+            return
+        if key not in self.columns:
+            self._data = np.concatenate([self._data, np.empty((1, self.height, self.width), np.float32)])
+            self.columns.append(key)
+        self._data[self.columns.index(key)] = self._as_plane(value)
+
+    def plane(self, key):
+        """列を [H, W] の平面として返す"""
+        return self._plane(key)
+
+    def copy(self):
+        table = PixelTable(self._data.copy(), self.columns, rows=self.rows)
+        if self._label is not None:
+            table._label = self._label.copy()
+        return table
+
+    def with_rows(self, rows):
+        """
+        行（ピクセル）の部分集合 rows を付けたコピーを返す
+        列アクセスは常に全行を返すので、rows は呼び出し側で適用する
+        """
+        table = self.copy()
+        table.rows = np.asarray(rows, dtype=bool).reshape(-1)
+        return table
+
+    def to_image(self, columns):
+        """指定した列を [H, W, C] の画像として返す（連続した列ならコピーなしのビュー）"""
+        idx = [self.columns.index(c) for c in columns]
+        if idx == list(range(idx[0], idx[0] + len(idx))):
+            return self._data[idx[0]:idx[0] + len(idx)].transpose(1, 2, 0)
+        return np.stack([self._data[i] for i in idx], axis=2)
 
 
-def mask2df(mask):
-    h, w = mask.shape
-    x_l, y_l = np.meshgrid(np.arange(h), np.arange(w), indexing='ij')
-    flg = mask.astype(int)
-    df = pd.DataFrame({
-        "x_l_m": x_l.ravel(),
-        "y_l_m": y_l.ravel(),
-        "m_flg": flg.ravel(),
-    })
-    return df
+def rgb2df(img):
+    return PixelTable.from_image(img, ("r", "g", "b"))
 
 
 def rgba2df(img):
-    h, w, _ = img.shape
-    x_l, y_l = np.meshgrid(np.arange(h), np.arange(w), indexing='ij')
-    r, g, b, a = img[:, :, 0], img[:, :, 1], img[:, :, 2], img[:, :, 3]
-    df = pd.DataFrame({
-        "x_l": x_l.ravel(),
-        "y_l": y_l.ravel(),
-        "r": r.ravel(),
-        "g": g.ravel(),
-        "b": b.ravel(),
-        "a": a.ravel()
-    })
+    df = PixelTable.from_image(img, ("r", "g", "b", "a")[:img.shape[2]])
+    if "a" not in df.columns:
+        df["a"] = 255
     return df
 
 
 def hsv2df(img):
-    x_l, y_l = np.meshgrid(np.arange(img.shape[0]), np.arange(img.shape[1]), indexing='ij')
-    h, s, v = np.transpose(img, (2, 0, 1))
-    df = pd.DataFrame(
-        {'x_l': x_l.flatten(), 'y_l': y_l.flatten(), 'h': h.flatten(), 's': s.flatten(), 'v': v.flatten()})
-    return df
+    return PixelTable.from_image(img, ("h", "s", "v"))
 
 
-def df2rgba(img_df):
-    r_img = img_df.pivot_table(index="x_l", columns="y_l", values="r").reset_index(drop=True).values
-    g_img = img_df.pivot_table(index="x_l", columns="y_l", values="g").reset_index(drop=True).values
-    b_img = img_df.pivot_table(index="x_l", columns="y_l", values="b").reset_index(drop=True).values
-    a_img = img_df.pivot_table(index="x_l", columns="y_l", values="a").reset_index(drop=True).values
+def _to_uint8(img):
+    return np.clip(img, 0, 255).astype(np.uint8)
 
-    if not (r_img.shape == g_img.shape == b_img.shape == a_img.shape):
-        return None
 
-    df_img = np.stack([r_img, g_img, b_img, a_img], 2).astype(np.uint8)
-    return df_img
+def df2rgba(img_df):
+    return _to_uint8(img_df.to_image(("r", "g", "b", "a")))
 
 
 def df2bgra(img_df):
-    r_img = img_df.pivot_table(index="x_l", columns="y_l", values="r").reset_index(drop=True).values
-    g_img = img_df.pivot_table(index="x_l", columns="y_l", values="g").reset_index(drop=True).values
-    b_img = img_df.pivot_table(index="x_l", columns="y_l", values="b").reset_index(drop=True).values
-    a_img = img_df.pivot_table(index="x_l", columns="y_l", values="a").reset_index(drop=True).values
-    df_img = np.stack([b_img, g_img, r_img, a_img], 2).astype(np.uint8)
-    return df_img
+    return _to_uint8(img_df.to_image(("b", "g", "r", "a")))
 
 
 def df2rgb(img_df):
-    r_img = img_df.pivot_table(index="x_l", columns="y_l", values="r").reset_index(drop=True).values
-    g_img = img_df.pivot_table(index="x_l", columns="y_l", values="g").reset_index(drop=True).values
-    b_img = img_df.pivot_table(index="x_l", columns="y_l", values="b").reset_index(drop=True).values
-    df_img = np.stack([r_img, g_img, b_img], 2).astype(np.uint8)
-    return df_img
+    return _to_uint8(img_df.to_image(("r", "g", "b")))
 
 
 def pil2cv(image):
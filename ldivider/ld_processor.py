@@ -1,88 +1,70 @@
 import cv2
-import pandas as pd
-from sklearn.cluster import MiniBatchKMeans
 import numpy as np
 #import matplotlib.pyplot as plt
 from tqdm import tqdm
 from skimage import color 
-from .ld_convertor import skimage_rgb2lab, df2rgba, rgba2df, hsv2df, rgb2df, mask2df
+from .ld_convertor import df2rgba, rgba2df, hsv2df, rgb2df
 #from .ld_utils import img_plot
 from .bg_remover import get_foreground
-
-def calc_ciede(mean_list, cls_list):
-  cls_no = []
-  tgt_no = []
-  ciede_list = []
-  for i in range(len(mean_list)):
-    img_1 = np.array(mean_list[i][:3])
-    for j in range(len(mean_list)):
-      if i == j:
-        continue
-      img_2 = np.array(mean_list[j][:3])
-      ciede = color.deltaE_ciede2000(skimage_rgb2lab(img_1), skimage_rgb2lab(img_2))[0][0]
-      ciede_list.append(ciede)
-      cls_no.append(cls_list[i])
-      tgt_no.append(cls_list[j])
-  ciede_df = pd.DataFrame({"cls_no": cls_no, "tgt_no": tgt_no, "ciede2000": ciede_list})
-  return ciede_df
-
-def get_mask(df, cls_no):
-  mask = df.copy()
-  mask.loc[df["label"] != cls_no, ["r","g","b"]] = 0
-  mask.loc[df["label"] == cls_no, ["r","g","b"]] = 255
-  mask = cv2.cvtColor(df2rgba(mask).astype(np.uint8), cv2.COLOR_RGBA2GRAY)
-  return mask
-
-def fill_mean_color(img_df, mask):
-  df_img = df2rgba(img_df).astype(np.uint8)
-  if len(df_img.shape) == 3:
-      mask = np.repeat(mask[:, :, np.newaxis], df_img.shape[-1], axis=-1)
-  masked_img = np.where(mask == 0, 0, df_img)
-  mean = np.mean(masked_img[mask != 0].reshape(-1, df_img.shape[-1]), axis=0)
-
-  img_df["r"] = mean[0]
-  img_df["g"] = mean[1]
-  img_df["b"] = mean[2]
-  
-  return img_df, mean
+from .ld_cluster import PaletteKMeans
+
+def calc_ciede(mean_list):
+  # 全クラス平均色を一度にLabへ変換し、上三角（i < j）の組だけCIEDE2000を計算する
+  # 戻り値は np.triu_indices(len(mean_list), k=1) の順に並んだ1次元配列
+  rgb = np.asarray(mean_list, dtype=np.float64).reshape(len(mean_list), -1)[:, :3]
+  if len(rgb) < 2:
+    return np.empty(0)
+  lab = color.rgb2lab(rgb.reshape(-1, 1, 3)).reshape(-1, 3)
+  cls_idx, tgt_idx = np.triu_indices(len(lab), k=1)
+  return color.deltaE_ciede2000(lab[cls_idx], lab[tgt_idx])
+
+def get_mean_color(df, columns=("r", "g", "b", "a")):
+  label = df["label"]
+  valid = label >= 0
+  cls_list, inverse = np.unique(label[valid], return_inverse=True)
+  counts = np.bincount(inverse, minlength=len(cls_list))
+  sums = [np.bincount(inverse, weights=df[c][valid], minlength=len(cls_list)) for c in columns]
+  mean_list = list(np.stack(sums, axis=1) / counts[:, np.newaxis])
+  return mean_list, cls_list.tolist(), counts
 
 def get_blur_cls(img, cls, size):
   blur_img = cv2.blur(img, (size, size))
   blur_df = rgba2df(blur_img)
   blur_df["label"] = cls
-  img_list = []
-  mean_list = []
-  cls_list = list(cls.unique())
-  for cls_no in tqdm(cls_list):
-    mask = get_mask(blur_df, cls_no)
-    img_df = blur_df.copy()
-    img_df.loc[blur_df["label"] != cls_no, ["a"]] = 0 
-    img_df, mean = fill_mean_color(img_df, mask)
-    df_img = df2rgba(img_df).astype(np.uint8)
-    img_list.append(df_img)
-    mean_list.append(mean)
-  return img_list, mean_list, cls_list
-
-def get_cls_update(ciede_df, df, threshold):
-    set_list = [frozenset({cls, tgt}) for cls, tgt in ciede_df[ciede_df['ciede2000'] < threshold][['cls_no', 'tgt_no']].to_numpy()]
-    merge_set = []
-    while set_list:
-        set_a = set_list.pop()
-        merged = False
-        for i, set_b in enumerate(merge_set):
-            if set_a & set_b:
-                merge_set[i] |= set_a
-                merged = True
-                break
-        if not merged:
-            merge_set.append(set_a)
-    merge_dict = {}
-    for merge in merge_set:
-        cls_counts = {cls: len(df[df['label'] == cls]) for cls in merge}
-        max_cls = max(cls_counts, key=cls_counts.get)
-        for cls in merge:
-            merge_dict[cls] = max_cls
-    return merge_dict
+  return get_mean_color(blur_df)
+
+def find_root(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def get_cls_update(ciede, cls_list, cls_counts, threshold):
+    # 色差が閾値未満のクラス同士をunion-findで推移的に統合し、各グループを画素数最大のクラスに寄せる
+    # 戻り値はラベル値 -> 統合先ラベル値の変換配列（labels = remap[labels] で適用できる）
+    n = len(cls_list)
+    parent = list(range(n))
+    cls_idx, tgt_idx = np.triu_indices(n, k=1)
+    close = np.asarray(ciede) < threshold
+    for i, j in zip(cls_idx[close], tgt_idx[close]):
+        root_i, root_j = find_root(parent, i), find_root(parent, j)
+        if root_i != root_j:
+            parent[root_j] = root_i
+
+    cls_counts = np.asarray(cls_counts)
+    best = {}
+    for i in range(n):
+        root = find_root(parent, i)
+        if root not in best or cls_counts[i] > cls_counts[best[root]]:
+            best[root] = i
+
+    cls_list = np.asarray(cls_list, dtype=np.int64)
+    remap = np.arange(cls_list.max() + 1 if n else 0)
+    remap[cls_list] = cls_list[[best[find_root(parent, i)] for i in range(n)]]
+    return remap
+
+def apply_remap(label, remap):
+    return np.where(label >= 0, remap[np.maximum(label, 0)], label)
 
 
 def get_color_dict(mean_list, cls_list):
@@ -91,201 +73,176 @@ def get_color_dict(mean_list, cls_list):
     color_dict.update({cls_list[idx]:{"r":mean[0],"g":mean[1],"b":mean[2], }})
   return color_dict
 
-def get_update_df(df, merge_dict, mean_list, cls_list):
+def fill_label_color(df, color_dict):
+  label = df["label"]
+  valid = label >= 0
+  cls_keys = np.array(sorted(color_dict.keys()))
+  idx = np.searchsorted(cls_keys, label[valid])
+  for c in ["r", "g", "b"]:
+    lut = np.array([color_dict[cls_no][c] for cls_no in cls_keys])
+    plane = df[c].copy()
+    plane[valid] = lut[idx]
+    df[c] = plane
+  return df
+
+def get_update_df(df, remap, mean_list, cls_list):
   update_df = df.copy()
-  update_df["label"] = update_df["label"].apply(lambda x: x if x not in merge_dict.keys() else merge_dict[x])
+  update_df["label"] = apply_remap(update_df["label"], remap)
   color_dict = get_color_dict(mean_list, cls_list)
-  update_df["r"] = update_df.apply(lambda x: color_dict[x["label"]]["r"], axis=1)
-  update_df["g"] = update_df.apply(lambda x: color_dict[x["label"]]["g"], axis=1)
-  update_df["b"] = update_df.apply(lambda x: color_dict[x["label"]]["b"], axis=1)    
+  update_df = fill_label_color(update_df, color_dict)
   return update_df, color_dict
 
-def split_img_df(df, show=False):
-  img_list = []
-  for cls_no in tqdm(list(df["label"].unique())):
-    img_df = df.copy()
-    img_df.loc[df["label"] != cls_no, ["a"]] = 0
-    df_img = df2rgba(img_df)
-    if df_img is None:
-      continue
-    df_img = df_img.astype(np.uint8)
-    img_list.append(df_img)
-  return img_list
+def get_label_bboxes(label):
+  flat = label.reshape(-1)
+  order = np.argsort(flat, kind="stable")
+  sorted_label = flat[order]
+  starts = np.flatnonzero(np.r_[True, sorted_label[1:] != sorted_label[:-1]])
+  rows, cols = np.divmod(order, label.shape[1])
+  top = np.minimum.reduceat(rows, starts)
+  bottom = np.maximum.reduceat(rows, starts) + 1
+  left = np.minimum.reduceat(cols, starts)
+  right = np.maximum.reduceat(cols, starts) + 1
+  return sorted_label[starts], top, bottom, left, right
+
+def iter_label_layers(img, label, crop=True):
+  for cls_no, top, bottom, left, right in zip(*get_label_bboxes(label)):
+    tile = img[top:bottom, left:right].copy()
+    tile[label[top:bottom, left:right] != cls_no, 3] = 0
+    if crop:
+      yield tile, (int(top), int(left))
+    else:
+      layer = np.zeros_like(img)
+      layer[top:bottom, left:right] = tile
+      yield layer
+
+def split_img(img, label, crop=False, lazy=False):
+  layers = iter_label_layers(img, label, crop=crop)
+  if lazy:
+    return layers
+  return list(tqdm(layers, total=len(np.unique(label))))
+
+def split_img_df(df, show=False, crop=False, lazy=False):
+  return split_img(df2rgba(df), df.plane("label"), crop=crop, lazy=lazy)
 
 
 def get_base(img, loops, cls_num, threshold, size, h_split, v_split, n_cluster, alpha, th_rate, bg_split=True, debug=False):
   if bg_split == False:
-    df = rgba2df(img)
-    df_list = [df]
+    src_df = rgba2df(img)
+    masks = [np.ones(len(src_df), dtype=bool)]
   else:
-    df_list = get_foreground(img, h_split, v_split, n_cluster, alpha, th_rate)
-
-  output_list = []
-
-  for idx, df in enumerate(df_list):
-    output_df = df.copy()
-    cls = MiniBatchKMeans(n_clusters = cls_num)
-    cls.fit(df[["r","g","b"]])
-    df["label"] = cls.labels_ 
-    df["label"] = df["label"].astype(str) + f"_{idx}"
+    src_df = rgb2df(img)
+    src_df["a"] = 255
+    masks = get_foreground(img, h_split, v_split, n_cluster, alpha, th_rate)
+
+  output_df = src_df.copy()
+  output_df["label"] = -1
+  output_df["layer_no"] = -1
+
+  for idx, mask in enumerate(masks):
+    df = src_df.with_rows(mask)
+    rows = df.rows
+    if not rows.any():
+      continue
+    cls = PaletteKMeans(n_clusters = cls_num)
+    label = np.full(len(df), -1, dtype=np.int64)
+    label[rows] = cls.fit_predict(df[["r","g","b"]][rows]) + idx * cls_num
+    df["label"] = label
     for i in range(loops):
-      if i !=0:
-        img = df2rgba(df).astype(np.uint8)
-      blur_list, mean_list, cls_list = get_blur_cls(img, df["label"], size)
-      ciede_df = calc_ciede(mean_list, cls_list)
-      merge_dict = get_cls_update(ciede_df, df, threshold)
-      update_df, color_dict = get_update_df(df, merge_dict, mean_list, cls_list)
+      img = df2rgba(df)
+      mean_list, cls_list, cls_counts = get_blur_cls(img, df["label"], size)
+      ciede = calc_ciede(mean_list)
+      remap = get_cls_update(ciede, cls_list, cls_counts, threshold)
+      update_df, color_dict = get_update_df(df, remap, mean_list, cls_list)
       df = update_df
       #if debug==True: img_plot(df)
-    output_df["label"] = df["label"]
-    output_df["layer_no"] = idx 
-    output_list.append(output_df)
-
-  output_df = pd.concat(output_list).sort_index()
-
-  mean_list = []
-  cls_list = list(output_df["label"].unique())
-  for cls_no in tqdm(cls_list):
-    mask = get_mask(output_df, cls_no)
-    img_df = output_df.copy()
-    img_df.loc[output_df["label"] != cls_no, ["a"]] = 0 
-    img_df, mean = fill_mean_color(img_df, mask)
-    mean_list.append(mean)
+    output_df["label"] = np.where(rows, df["label"], output_df["label"])
+    output_df["layer_no"] = np.where(rows, idx, output_df["layer_no"])
 
+  mean_list, cls_list, _ = get_mean_color(output_df)
   color_dict = get_color_dict(mean_list, cls_list)
-  output_df["r"] = output_df.apply(lambda x: color_dict[x["label"]]["r"], axis=1)
-  output_df["g"] = output_df.apply(lambda x: color_dict[x["label"]]["g"], axis=1)
-  output_df["b"] = output_df.apply(lambda x: color_dict[x["label"]]["b"], axis=1)  
+  output_df = fill_label_color(output_df, color_dict)
   
   return output_df
 
-def set_label(x, idx):
-  if x["m_flg"] == True:
-    return idx
-  else :
-    return x["label"]
-
-def mode_fast(series):
-    return series.mode().iloc[0]
+def mode_by_label(label, values):
+  cls_list, inverse = np.unique(label, return_inverse=True)
+  hist = np.bincount(inverse * 256 + values.astype(np.int64), minlength=len(cls_list) * 256)
+  return hist.reshape(-1, 256).argmax(axis=1)[inverse]
 
 def get_seg_base(input_image, masks, th):
   df = rgba2df(input_image)
-  df["label"] = -1
+  label = np.full((df.height, df.width), -1, dtype=np.int64)
   for idx, mask in tqdm(enumerate(masks)):
     if int(mask["area"] < th):
       continue
-    mask_df = mask2df(mask["segmentation"])
-    df = df.merge(mask_df, left_on=["x_l", "y_l"], right_on=["x_l_m", "y_l_m"], how="inner")
-    df["label"] = np.where(df["m_flg"] == True, idx, df["label"])
-    df.drop(columns=["x_l_m", "y_l_m", "m_flg"], inplace=True)
-
-  df['r'] = df.groupby('label')['r'].transform(mode_fast)
-  df['g'] = df.groupby('label')['g'].transform(mode_fast)
-  df['b'] = df.groupby('label')['b'].transform(mode_fast)
+    label[mask["segmentation"].astype(bool)] = idx
+  df["label"] = label
+
+  df['r'] = mode_by_label(df['label'], df['r'])
+  df['g'] = mode_by_label(df['label'], df['g'])
+  df['b'] = mode_by_label(df['label'], df['b'])
   return df
 
-def get_normal_layer(input_image, df):
-  base_layer_list = split_img_df(df, show=False)
+def get_normal_layer(input_image, df, crop=False, lazy=False):
+  base_layer_list = split_img_df(df, show=False, crop=crop, lazy=lazy)
 
   org_df = rgba2df(input_image)
-  hsv_df = hsv2df(cv2.cvtColor(df2rgba(df).astype(np.uint8), cv2.COLOR_RGB2HSV))
+  hsv_df = hsv2df(cv2.cvtColor(df2rgba(df), cv2.COLOR_RGB2HSV))
   hsv_org = hsv2df(cv2.cvtColor(input_image, cv2.COLOR_RGB2HSV))
 
-  hsv_org["bright_flg"] = hsv_df["v"] < hsv_org["v"]
+  bright_flg = hsv_df["v"] < hsv_org["v"]
   bright_df = org_df.copy()
-  bright_df["bright_flg"] = hsv_org["bright_flg"]
-  bright_df["a"] = np.where(bright_df["bright_flg"] == True, 255, 0)
+  bright_df["a"] = np.where(bright_flg, 255, 0)
   bright_df["label"] = df["label"]
-  bright_layer_list = split_img_df(bright_df, show=False)
+  bright_layer_list = split_img_df(bright_df, show=False, crop=crop, lazy=lazy)
 
-  hsv_org["shadow_flg"] = hsv_df["v"] >= hsv_org["v"]
-  shadow_df = rgba2df(input_image)
-  shadow_df["shadow_flg"] = hsv_org["shadow_flg"]
-  shadow_df["a"] = np.where(shadow_df["shadow_flg"] == True, 255, 0)
+  shadow_flg = hsv_df["v"] >= hsv_org["v"]
+  shadow_df = org_df.copy()
+  shadow_df["a"] = np.where(shadow_flg, 255, 0)
   shadow_df["label"] = df["label"]
-  shadow_layer_list = split_img_df(shadow_df, show=True)
+  shadow_layer_list = split_img_df(shadow_df, show=True, crop=crop, lazy=lazy)
     
   return base_layer_list, bright_layer_list, shadow_layer_list
 
 
-def get_composite_layer(input_image, df):
-  base_layer_list = split_img_df(df, show=False)
-
-  org_df = rgba2df(input_image)
-
-  org_df["r"] = org_df["r"].apply(lambda x:int(x))
-  org_df["g"] = org_df["g"].apply(lambda x:int(x))
-  org_df["b"] = org_df["b"].apply(lambda x:int(x))
-
-  org_df["diff_r"] = df["r"] - org_df["r"]
-  org_df["diff_g"] = df["g"] - org_df["g"]
-  org_df["diff_b"] = df["b"] - org_df["b"]
-  
-  org_df["shadow_flg"] = org_df.apply(
-    lambda x: True if x["diff_r"] >= 0 and x["diff_g"] >= 0 and x["diff_b"] >= 0 else False,
-    axis=1
-  )
-  org_df["screen_flg"] = org_df.apply(
-    lambda x: True if x["diff_r"] < 0 and x["diff_g"] < 0 and x["diff_b"] < 0 else False,
-    axis=1
-  )
-    
-
-  shadow_df = org_df.copy()
-  shadow_df["a"] = org_df.apply(lambda x: 255 if x["shadow_flg"] == True else 0, axis=1)
-  
-  shadow_df["r"] = shadow_df["r"].apply(lambda x: x*255)
-  shadow_df["g"] = shadow_df["g"].apply(lambda x: x*255)
-  shadow_df["b"] = shadow_df["b"].apply(lambda x: x*255)
-
-  shadow_df["r"] = (shadow_df["r"])/df["r"]
-  shadow_df["g"] = (shadow_df["g"])/df["g"]
-  shadow_df["b"] = (shadow_df["b"])/df["b"]
-  
-  shadow_df["label"] = df["label"]
-  shadow_layer_list = split_img_df(shadow_df, show=True)
-
-  screen_df = org_df.copy()
-
-  screen_df["a"] = screen_df["screen_flg"].apply(lambda x: 255 if x == True else 0)
-
-  screen_df["r"] = (screen_df["r"] - df["r"])/(1 - df["r"]/255) 
-  screen_df["g"] = (screen_df["g"] - df["g"])/(1 - df["g"]/255) 
-  screen_df["b"] = (screen_df["b"] - df["b"])/(1 - df["b"]/255) 
-
-  screen_df["label"] = df["label"]
-  screen_layer_list = split_img_df(screen_df, show=True)
-
-  
-  addition_df = org_df.copy()
-  addition_df["a"] = addition_df.apply(lambda x: 255 if x["screen_flg"] == False and x["shadow_flg"] == False else 0, axis=1)
-
-  addition_df["r"] = org_df["r"] - df["r"] 
-  addition_df["g"] = org_df["g"] - df["g"] 
-  addition_df["b"] = org_df["b"] - df["b"]  
-
-  addition_df["r"] = addition_df["r"].apply(lambda x: 0 if x < 0 else x)
-  addition_df["g"] = addition_df["g"].apply(lambda x: 0 if x < 0 else x)
-  addition_df["b"] = addition_df["b"].apply(lambda x: 0 if x < 0 else x)
-
-  addition_df["label"] = df["label"]
-
-  addition_layer_list = split_img_df(addition_df, show=True)
-
-  subtract_df = org_df.copy()
-  subtract_df["a"] = subtract_df.apply(lambda x: 255 if x["screen_flg"] == False and x["shadow_flg"] == False else 0, axis=1)
-
-  subtract_df["r"] = df["r"] - org_df["r"]   
-  subtract_df["g"] = df["g"] - org_df["g"] 
-  subtract_df["b"] = df["b"] - org_df["b"]
-
-  subtract_df["r"] = subtract_df["r"].apply(lambda x: 0 if x < 0 else x)
-  subtract_df["g"] = subtract_df["g"].apply(lambda x: 0 if x < 0 else x)
-  subtract_df["b"] = subtract_df["b"].apply(lambda x: 0 if x < 0 else x)
-
-  subtract_df["label"] = df["label"]
-
-  subtract_layer_list = split_img_df(subtract_df, show=True)
-
+# 元画像をベース色と4種類の合成モードに分解し、[4, H, W, 4] の
+# shadow(乗算), screen, addition, subtract レイヤーを一度に計算する
+def get_composite_planes(input_image, base_image):
+  org = input_image[:, :, :3].astype(np.float32)
+  base = base_image[:, :, :3].astype(np.float32)
+  diff = base - org
+
+  shadow_flg = (diff >= 0).all(axis=2)
+  screen_flg = (diff < 0).all(axis=2)
+  other_flg = ~(shadow_flg | screen_flg)
+
+  layers = np.empty((4, *org.shape[:2], 4), dtype=np.float32)
+
+  # 乗算: org = base * x / 255 → x = org * 255 / base（base == 0 は乗算の中立色 255）
+  layers[0, :, :, :3] = 255
+  np.divide(org * 255, base, out=layers[0, :, :, :3], where=base > 0)
+  # スクリーン: org = base + x * (1 - base / 255)（base == 255 はスクリーンの中立色 0）
+  layers[1, :, :, :3] = 0
+  np.divide(-diff, 1 - base / 255, out=layers[1, :, :, :3], where=base < 255)
+  # 加算・減算
+  np.maximum(-diff, 0, out=layers[2, :, :, :3])
+  np.maximum(diff, 0, out=layers[3, :, :, :3])
+
+  layers[0, :, :, 3] = shadow_flg * 255
+  layers[1, :, :, 3] = screen_flg * 255
+  layers[2, :, :, 3] = other_flg * 255
+  layers[3, :, :, 3] = other_flg * 255
+  return layers
+
+
+def get_composite_layer(input_image, df, crop=False, lazy=False):
+  base_img = df2rgba(df)
+  label = df.plane("label")
+  base_layer_list = split_img(base_img, label, crop=crop, lazy=lazy)
+
+  layers = np.clip(get_composite_planes(input_image, df.to_image(("r", "g", "b"))), 0, 255).astype(np.uint8)
+  shadow_layer_list, screen_layer_list, addition_layer_list, subtract_layer_list = [
+    split_img(layer, label, crop=crop, lazy=lazy) for layer in layers
+  ]
 
   return base_layer_list, shadow_layer_list, screen_layer_list, addition_layer_list, subtract_layer_list
@@ -3,12 +3,85 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from einops import rearrange
-from sklearn.cluster import MiniBatchKMeans
-from sklearn.utils import shuffle
 
+from .ld_processor import get_cls_update
+from .ld_cluster import PaletteKMeans
 
-from .ld_processor import calc_ciede
-from .ld_processor_np import get_cls_update
+
+# skimage.color.rgb2lab / deltaE_ciede2000 と同じ定数（sRGB, D65, 2°）
+XYZ_FROM_RGB = [[0.412453, 0.357580, 0.180423],
+                [0.212671, 0.715160, 0.072169],
+                [0.019334, 0.119193, 0.950227]]
+XYZ_REF_WHITE = [0.95047, 1.0, 1.08883]
+
+
+def rgb2lab_torch(rgb: torch.Tensor):
+    arr = torch.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = arr @ torch.tensor(XYZ_FROM_RGB, dtype=rgb.dtype, device=rgb.device).T
+    xyz = xyz / torch.tensor(XYZ_REF_WHITE, dtype=rgb.dtype, device=rgb.device)
+    xyz = torch.where(xyz > 0.008856, xyz.clamp(min=0) ** (1 / 3), 7.787 * xyz + 16.0 / 116.0)
+    x, y, z = xyz.unbind(-1)
+    return torch.stack([116.0 * y - 16.0, 500.0 * (x - y), 200.0 * (y - z)], dim=-1)
+
+
+def deltaE_ciede2000_torch(lab1: torch.Tensor, lab2: torch.Tensor):
+    two_pi = 2 * np.pi
+    L1, a1, b1 = lab1.unbind(-1)
+    L2, a2, b2 = lab2.unbind(-1)
+
+    Cbar = 0.5 * (torch.hypot(a1, b1) + torch.hypot(a2, b2))
+    c7 = Cbar ** 7
+    G = 0.5 * (1 - torch.sqrt(c7 / (c7 + 25 ** 7)))
+    scale = 1 + G
+    C1, h1 = torch.hypot(a1 * scale, b1), torch.remainder(torch.atan2(b1, a1 * scale), two_pi)
+    C2, h2 = torch.hypot(a2 * scale, b2), torch.remainder(torch.atan2(b2, a2 * scale), two_pi)
+
+    Lbar = 0.5 * (L1 + L2)
+    tmp = (Lbar - 50) ** 2
+    SL = 1 + 0.015 * tmp / torch.sqrt(20 + tmp)
+    L_term = (L2 - L1) / SL
+
+    Cbar = 0.5 * (C1 + C2)
+    SC = 1 + 0.045 * Cbar
+    C_term = (C2 - C1) / SC
+
+    h_diff = h2 - h1
+    h_sum = h1 + h2
+    CC = C1 * C2
+
+    dH = torch.where(h_diff > np.pi, h_diff - two_pi, h_diff)
+    dH = torch.where(h_diff < -np.pi, h_diff + two_pi, dH)
+    dH = torch.where(CC == 0.0, torch.zeros_like(dH), dH)
+    dH_term = 2 * torch.sqrt(CC) * torch.sin(dH / 2)
+
+    mask = (CC != 0.0) & (h_diff.abs() > np.pi)
+    Hbar = torch.where(mask & (h_sum < two_pi), h_sum + two_pi, h_sum)
+    Hbar = torch.where(mask & (h_sum >= two_pi), h_sum - two_pi, Hbar)
+    Hbar = torch.where(CC == 0.0, Hbar * 2, Hbar) * 0.5
+
+    T = (1
+         - 0.17 * torch.cos(Hbar - np.deg2rad(30))
+         + 0.24 * torch.cos(2 * Hbar)
+         + 0.32 * torch.cos(3 * Hbar + np.deg2rad(6))
+         - 0.20 * torch.cos(4 * Hbar - np.deg2rad(63)))
+    SH = 1 + 0.015 * Cbar * T
+    H_term = dH_term / SH
+
+    c7 = Cbar ** 7
+    Rc = 2 * torch.sqrt(c7 / (c7 + 25 ** 7))
+    dtheta = np.deg2rad(30) * torch.exp(-((torch.rad2deg(Hbar) - 275) / 25) ** 2)
+    R_term = -torch.sin(2 * dtheta) * Rc * C_term * H_term
+
+    dE2 = L_term ** 2 + C_term ** 2 + H_term ** 2 + R_term
+    return torch.sqrt(dE2.clamp(min=0))
+
+
+def calc_ciede_torch(rgb_means: torch.Tensor):
+    # ld_processor.calc_ciede と同じ上三角順の1次元テンソルをデバイス上で計算する
+    n = rgb_means.shape[0]
+    lab = rgb2lab_torch(rgb_means[:, :3])
+    cls_idx, tgt_idx = torch.triu_indices(n, n, offset=1, device=rgb_means.device)
+    return deltaE_ciede2000_torch(lab[cls_idx], lab[tgt_idx])
 
 
 def get_blur_torch(img: torch.Tensor, labels: torch.Tensor, size, blur=True):
@@ -18,17 +91,30 @@ def get_blur_torch(img: torch.Tensor, labels: torch.Tensor, size, blur=True):
         img = F.pad(img, [p, p, p, p], mode='reflect')
         img = F.avg_pool2d(img, kernel_size=size, stride=1)
     
-    cls = torch.unique(labels).reshape(-1, 1, 1, 1)
-    masks = torch.bitwise_and(img[:, [3]] > 127, cls == labels)
+    # ラベルごとの画素数とRGB合計をscatter_addで一度に集計（クラス数 x 画素数のマスクは作らない）
+    flat = labels.reshape(-1)
+    opaque = img[:, [3]] > 127
+    sel = opaque.reshape(-1).to(img.dtype)
+    n = int(flat.max()) + 1
+    cls = torch.nonzero(torch.bincount(flat, minlength=n)).reshape(-1)
+    cls_counts = torch.zeros(n, dtype=img.dtype, device=img.device).scatter_add_(0, flat, sel)
+    rgb_sums = torch.zeros((3, n), dtype=img.dtype, device=img.device).scatter_add_(
+        1, flat.expand(3, -1), img[0, :3].reshape(3, -1) * sel)
+    cls_counts = cls_counts[cls] + 1e-7
+    rgb_means = rgb_sums[:, cls].T / cls_counts[:, None]
 
-    cls_counts = masks.sum(dim=(2, 3), keepdim=True) + 1e-7
-    rgb_means = (img[:, :3] * masks).sum(dim=(2, 3), keepdim=True) / cls_counts
-    
-    rgb_means = rgb_means.squeeze().cpu().tolist()
-    cls_list = cls.squeeze().cpu().tolist()
-    cls_counts = cls_counts.squeeze().cpu().tolist()
+    cls_list = cls.cpu().tolist()
+    cls_counts = cls_counts.cpu().tolist()
     
-    return rgb_means, cls_list, cls_counts, masks
+    return rgb_means, cls_list, cls_counts, opaque
+
+
+def fill_label_rgb_torch(img: torch.Tensor, labels: torch.Tensor, opaque: torch.Tensor, rgb_means, cls_list):
+    rgb_lut = torch.zeros((max(int(labels.max()), max(cls_list)) + 1, 3), dtype=img.dtype, device=img.device)
+    rgb_lut[cls_list] = rgb_means
+    label_rgb = rearrange(rgb_lut[labels[0, 0]], 'h w c -> c h w')[None]
+    img[:, :3] = torch.where(opaque, label_rgb, img[:, :3])
+    return img
 
 
 def get_base_torch(img: np.ndarray, loop, cls_num, threshold, size, kmeans_samples=-1, device='cpu'):
@@ -36,61 +122,32 @@ def get_base_torch(img: np.ndarray, loop, cls_num, threshold, size, kmeans_sampl
     im_h, im_w = img.shape[:2]
 
     alpha_mask = np.where(img[..., 3] > 127)
-    resampled = False
     if rgb_flatten.shape[0] > len(alpha_mask[0]):
         cluster_samples = img[..., :3][alpha_mask].reshape((-1, 3))
-        resampled = True
-
-    if len(rgb_flatten) > kmeans_samples and kmeans_samples > 0:
-        cluster_samples = shuffle(cluster_samples, random_state=0, n_samples=kmeans_samples)
-        resampled = True
 
-    kmeans = MiniBatchKMeans(n_clusters=cls_num).fit(cluster_samples)
-    if resampled:
-        labels = kmeans.predict(rgb_flatten)
-    else:
-        labels = kmeans.labels_
+    kmeans = PaletteKMeans(n_clusters=cls_num, n_samples=kmeans_samples, device=device).fit(cluster_samples)
+    labels = kmeans.predict(rgb_flatten)
 
     img_torch = rearrange([img], 'n h w c -> n c h w')
     img_torch = torch.from_numpy(img_torch).to(dtype=torch.float32, device=device)
-    labels_torch = torch.from_numpy(labels.reshape((1, 1, im_h, im_w))).to(dtype=torch.float32, device=device)
+    labels_torch = torch.from_numpy(labels.reshape((1, 1, im_h, im_w))).to(dtype=torch.int64, device=device)
 
     assert loop > 0
     img_torch_ori = img_torch.clone()
     for i in range(loop):
-        rgb_means, cls_list, cls_counts, masks = get_blur_torch(img_torch, labels_torch, size)
-        ciede_df = calc_ciede(rgb_means, cls_list)
-        cls2rgb, cls2counts, cls2masks = {}, {}, {}
-        for c, rgb, count, mask in zip(cls_list, rgb_means, cls_counts, masks):
-            cls2rgb[c] = rgb
-            cls2counts[c] = count
-            cls2masks[c] = mask[None, ...]
-        merge_dict = get_cls_update(ciede_df, threshold, cls2counts)
-        tgt2merge, notmerged = {}, set(cls_list)
-        for k, v in merge_dict.items():
-            if v not in tgt2merge:
-                tgt2merge[v] = []
-                notmerged.remove(v)
-            tgt2merge[v].append(k)
-            notmerged.remove(k)
-        for k in notmerged:
-            tgt2merge[k] = []
-
-        for tgtc, srcc_list in tgt2merge.items():
-            mask = cls2masks[tgtc]
-            for srcc in srcc_list:
-                mask = torch.bitwise_or(mask, cls2masks[srcc])
-            labels_torch.masked_fill_(mask, tgtc)
-            if i != loop - 1:
-                for jj in range(3):
-                    img_torch[:, jj].masked_fill_(mask[0], cls2rgb[tgtc][jj])
-
-    cls_list = torch.unique(labels_torch)
+        rgb_means, cls_list, cls_counts, opaque = get_blur_torch(img_torch, labels_torch, size)
+        ciede = calc_ciede_torch(rgb_means).cpu().numpy()
+        remap = get_cls_update(ciede, cls_list, cls_counts, threshold)
+        remap = torch.from_numpy(remap).to(device)
+
+        # 統合先ラベルを変換表で一括適用（不透明画素のみ）
+        labels_torch = torch.where(opaque, remap[labels_torch], labels_torch)
+        if i != loop - 1:
+            img_torch = fill_label_rgb_torch(img_torch, labels_torch, opaque, rgb_means, cls_list)
+
     img_torch = img_torch_ori
-    rgb_means, cls_list, cls_counts, masks = get_blur_torch(img_torch, labels_torch, size, blur=False)
-    for mask, rgb in zip(masks, rgb_means):
-        for jj in range(3):
-            img_torch[:, jj][mask] = rgb[jj]
+    rgb_means, cls_list, cls_counts, opaque = get_blur_torch(img_torch, labels_torch, size, blur=False)
+    img_torch = fill_label_rgb_torch(img_torch, labels_torch, opaque, rgb_means, cls_list)
     
     img = rearrange(img_torch.cpu().numpy(), 'n c h w -> h w (n c)')
     img = img.clip(0, 255).astype(np.uint8)
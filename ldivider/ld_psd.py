@@ -0,0 +1,253 @@
+import os
+import shutil
+import struct
+import tempfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+
+BLEND_MODES = {
+    "pass_through": b"pass", "normal": b"norm", "dissolve": b"diss", "darken": b"dark",
+    "multiply": b"mul ", "color_burn": b"idiv", "linear_burn": b"lbrn", "darker_color": b"dkCl",
+    "lighten": b"lite", "screen": b"scrn", "color_dodge": b"div ", "linear_dodge": b"lddg",
+    "lighter_color": b"lgCl", "overlay": b"over", "soft_light": b"sLit", "hard_light": b"hLit",
+    "vivid_light": b"vLit", "linear_light": b"lLit", "pin_light": b"pLit", "hard_mix": b"hMix",
+    "difference": b"diff", "exclusion": b"smud", "subtract": b"fsub", "divide": b"fdiv",
+    "hue": b"hue ", "saturation": b"sat ", "color": b"colr", "luminosity": b"lum ",
+}
+
+
+# lsct（セクション区切り）の種類
+OPEN_FOLDER = 1
+CLOSED_FOLDER = 2
+BOUNDING_SECTION_DIVIDER = 3
+
+
+def blend_key(mode):
+    # pytoshopのBlendMode、4文字のキー、モード名のいずれも受け付ける
+    mode = getattr(mode, "value", mode)
+    if isinstance(mode, str):
+        if mode in BLEND_MODES:
+            return BLEND_MODES[mode]
+        mode = mode.encode("ascii")
+    if len(mode) != 4:
+        raise ValueError(f"Unknown blend mode: {mode!r}")
+    return bytes(mode)
+
+
+def _chunks(starts, lengths, size=128):
+    # 長さ size を超える区間を size ごとのパケットに分割する
+    count = (lengths + size - 1) // size
+    packet = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+    start = np.repeat(starts, count) + packet * size
+    length = np.minimum(np.repeat(lengths, count) - packet * size, size)
+    return start, length
+
+
+def packbits(channel):
+    """
+    2次元のuint8配列を行ごとにPackBits圧縮する
+    戻り値: (各行のバイト数, 圧縮データ)
+    """
+    h, w = channel.shape
+    flat = np.ascontiguousarray(channel).reshape(-1)
+    if flat.size == 0:
+        return np.zeros(h, dtype=np.int64), b""
+
+    # 同じ値が続く区間（行の先頭では必ず区切る）
+    run_head = np.ones(flat.size, dtype=bool)
+    run_head[1:] = flat[1:] != flat[:-1]
+    run_head[::w] = True
+    run_start = np.flatnonzero(run_head)
+    run_len = np.diff(np.append(run_start, flat.size))
+    run_row = run_start // w
+
+    # 3画素以上の連続は繰り返しパケット、それ以外は隣接するものをまとめて非圧縮パケット
+    repeat = run_len >= 3
+    literal = ~repeat
+    seg_head = literal.copy()
+    seg_head[1:] &= ~literal[:-1] | (run_row[1:] != run_row[:-1])
+    seg_id = np.cumsum(seg_head) - 1
+    seg_start = run_start[seg_head]
+    seg_len = np.bincount(seg_id[literal], weights=run_len[literal], minlength=len(seg_start)).astype(np.int64)
+
+    rep_start, rep_len = _chunks(run_start[repeat], run_len[repeat])
+    lit_start, lit_len = _chunks(seg_start, seg_len)
+
+    start = np.concatenate([rep_start, lit_start])
+    length = np.concatenate([rep_len, lit_len])
+    is_lit = np.concatenate([np.zeros(len(rep_start), dtype=bool), np.ones(len(lit_start), dtype=bool)])
+    order = np.argsort(start, kind="stable")
+    start, length, is_lit = start[order], length[order], is_lit[order]
+
+    size = np.where(is_lit, length + 1, 2)
+    offset = np.cumsum(size) - size
+    out = np.empty(int(size.sum()), dtype=np.uint8)
+    out[offset] = np.where(is_lit, length - 1, 257 - length).astype(np.uint8)
+    out[offset[~is_lit] + 1] = flat[start[~is_lit]]
+    lit_len = length[is_lit]
+    k = np.arange(lit_len.sum()) - np.repeat(np.cumsum(lit_len) - lit_len, lit_len)
+    out[np.repeat(offset[is_lit] + 1, lit_len) + k] = flat[np.repeat(start[is_lit], lit_len) + k]
+
+    row_bytes = np.bincount(start // w, weights=size, minlength=h).astype(np.int64)
+    return row_bytes, out.tobytes()
+
+
+def encode_channel(channel):
+    # チャンネルデータ（圧縮方式 + 行ごとのバイト数 + PackBitsデータ）
+    if channel.size == 0:
+        return struct.pack(">H", 0)
+    row_bytes, data = packbits(channel)
+    return struct.pack(">H", 1) + row_bytes.astype(">u2").tobytes() + data
+
+
+def alpha_bbox(alpha):
+    rows = np.flatnonzero(alpha.any(axis=1))
+    cols = np.flatnonzero(alpha.any(axis=0))
+    if len(rows) == 0:
+        return None
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+
+def pascal_name(name):
+    data = name.encode("ascii", "replace")[:255]
+    data = bytes([len(data)]) + data
+    return data + b"\x00" * (-len(data) % 4)
+
+
+def unicode_name(name):
+    data = name.encode("utf-16-be")
+    data = struct.pack(">I", len(name.encode("utf-16-le")) // 2) + data
+    return b"8BIMluni" + struct.pack(">I", len(data)) + data
+
+
+class PsdWriter:
+    """
+    PSDファイルを逐次書き出すライター
+
+    add_layer で渡したレイヤーは不透明部分の範囲に切り抜かれ、
+    チャンネルごとのPackBits圧縮をスレッドプールで並列に行う。
+    圧縮済みデータは一時ファイルに書き出し、close でレイヤーレコードの後ろに連結する。
+    begin_group / end_group で囲んだレイヤーはグループ（フォルダ）にまとめられる。
+    """
+
+    def __init__(self, path, width, height, max_workers=None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.records = []
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_pending = self.pool._max_workers * 2
+        self.pending = deque()
+        self.groups = []
+        self.channel_file = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+
+    def add_layer(self, img, name, mode="normal", top=0, left=0, opacity=255):
+        """img: [H, W, 4] uint8（top, left はキャンバス上の位置）"""
+        img = np.asarray(img)
+        bbox = alpha_bbox(img[:, :, 3])
+        if bbox is None:
+            img = img[:0, :0]
+            top = left = 0
+        else:
+            y0, y1, x0, x1 = bbox
+            img = img[y0:y1, x0:x1]
+            top, left = top + y0, left + x0
+
+        # アルファ(-1)とRGB(0, 1, 2)の順で圧縮
+        futures = [self.pool.submit(encode_channel, img[:, :, c]) for c in (3, 0, 1, 2)]
+        record = {
+            "name": name, "mode": blend_key(mode), "opacity": opacity,
+            "top": top, "left": left, "bottom": top + img.shape[0], "right": left + img.shape[1],
+        }
+        self.pending.append((record, futures))
+        while len(self.pending) > self.max_pending:
+            self._flush_one()
+
+    def begin_group(self, name, mode="pass_through", opened=True):
+        # PSDは下のレイヤーから順に記録するため、グループの終端を先に書く
+        self.groups.append((name, mode, opened))
+        self._add_section("</Layer set>", "normal", BOUNDING_SECTION_DIVIDER)
+
+    def end_group(self):
+        name, mode, opened = self.groups.pop()
+        self._add_section(name, mode, OPEN_FOLDER if opened else CLOSED_FOLDER)
+
+    def _add_section(self, name, mode, section):
+        empty = Future()
+        empty.set_result(struct.pack(">H", 0))
+        record = {
+            "name": name, "mode": blend_key(mode), "opacity": 255,
+            "top": 0, "left": 0, "bottom": 0, "right": 0, "section": section,
+        }
+        self.pending.append((record, [empty] * 4))
+
+    def _flush_one(self):
+        record, futures = self.pending.popleft()
+        lengths = []
+        for future in futures:
+            data = future.result()
+            self.channel_file.write(data)
+            lengths.append(len(data))
+        record["lengths"] = lengths
+        self.records.append(record)
+
+    def _layer_record(self, record):
+        header = struct.pack(">iiiiH", record["top"], record["left"], record["bottom"], record["right"], 4)
+        for channel_id, length in zip((-1, 0, 1, 2), record["lengths"]):
+            header += struct.pack(">hI", channel_id, length)
+        section = record.get("section")
+        # グループのレコードはピクセルデータを持たない（flags: bit3 + bit4）
+        flags = 0x18 if section else 0
+        header += b"8BIM" + record["mode"] + struct.pack(">BBBB", record["opacity"], 0, flags, 0)
+        extra = struct.pack(">II", 0, 0) + pascal_name(record["name"]) + unicode_name(record["name"])
+        if section:
+            extra += b"8BIMlsct" + struct.pack(">II", 12, section) + b"8BIM" + record["mode"]
+        return header + struct.pack(">I", len(extra)) + extra
+
+    def close(self, composite=None):
+        """composite: 統合画像 [H, W, 3] uint8（省略時は白）"""
+        if self.groups:
+            self.abort()
+            raise ValueError(f"Group not closed: {self.groups[-1][0]}")
+        while self.pending:
+            self._flush_one()
+        if composite is None:
+            composite = np.full((self.height, self.width, 3), 255, dtype=np.uint8)
+        composite = np.asarray(composite).astype(np.uint8, copy=False)
+        encoded = list(self.pool.map(packbits, [composite[:, :, c] for c in range(3)]))
+        self.pool.shutdown()
+
+        records = b"".join(self._layer_record(record) for record in self.records)
+        channel_size = self.channel_file.tell()
+        layer_info_size = 2 + len(records) + channel_size
+        layer_info_pad = layer_info_size % 2
+
+        with open(self.path, "wb") as f:
+            f.write(b"8BPS" + struct.pack(">H6xHIIHH", 1, 3, self.height, self.width, 8, 3))
+            f.write(struct.pack(">I", 0))  # カラーモードデータ
+            f.write(struct.pack(">I", 0))  # イメージリソース
+            f.write(struct.pack(">I", 4 + layer_info_size + layer_info_pad + 4))
+            f.write(struct.pack(">I", layer_info_size + layer_info_pad))
+            f.write(struct.pack(">h", len(self.records)))
+            f.write(records)
+            self.channel_file.seek(0)
+            shutil.copyfileobj(self.channel_file, f, 16 * 1024 * 1024)
+            f.write(b"\x00" * layer_info_pad)
+            f.write(struct.pack(">I", 0))  # グローバルレイヤーマスク
+
+            # 統合画像（全チャンネルの行バイト数を先にまとめて書く）
+            f.write(struct.pack(">H", 1))
+            for row_bytes, _ in encoded:
+                f.write(row_bytes.astype(">u2").tobytes())
+            for _, data in encoded:
+                f.write(data)
+
+        self.channel_file.close()
+        return self.path
+
+    def abort(self):
+        self.pool.shutdown(cancel_futures=True)
+        self.channel_file.close()
@@ -4,10 +4,12 @@ Morphology Operations Node for ComfyUI
 """
 
 import torch
+import torch.nn.functional as F
 import numpy as np
 from PIL import Image
 import cv2
 import folder_paths
+import logging
 import os
 
 # パス設定
@@ -18,34 +20,241 @@ output_dir = f"{custom_nodes_path}/output"
 if not os.path.exists(output_dir):
     os.makedirs(output_dir)
 
+logger = logging.getLogger(__name__)
 
-def tensor_to_pil(tensor):
-    """ComfyUIのテンソル形式をPIL Imageに変換"""
-    image_np = tensor.cpu().detach().numpy()
-    if len(image_np.shape) == 4:
-        image_np = image_np[0]  # バッチの最初の画像を取得
-    image_np = (image_np * 255).astype(np.uint8)
-    
-    if len(image_np.shape) == 3:
-        if image_np.shape[2] == 3:
-            mode = 'RGB'
-        elif image_np.shape[2] == 4:
-            mode = 'RGBA'
-        else:
-            mode = 'L'
+
+KERNEL_SHAPES = {
+    "rectangle": cv2.MORPH_RECT,
+    "ellipse": cv2.MORPH_ELLIPSE,
+    "cross": cv2.MORPH_CROSS,
+}
+
+
+def get_kernel(kernel_shape, kernel_size):
+    """OpenCVと同じ構造要素（uint8の2次元配列）を返す"""
+    shape = KERNEL_SHAPES.get(kernel_shape, cv2.MORPH_ELLIPSE)
+    return cv2.getStructuringElement(shape, (kernel_size, kernel_size))
+
+
+def to_gray(image):
+    """
+    ComfyUIの画像 [B, H, W, C] をuint8のグレースケール [B, 1, H, W] に変換
+    OpenCVのCOLOR_RGB2GRAYと同じ係数を使う（torch・OpenCVのどちらの処理もこの結果から始める）
+    """
+    if image.shape[-1] >= 3:
+        weights = torch.tensor([0.299, 0.587, 0.114], dtype=image.dtype, device=image.device)
+        gray = image[..., :3] @ weights
     else:
-        mode = 'L'
-    
-    return Image.fromarray(image_np, mode=mode)
+        gray = image[..., 0]
+    return (gray * 255).round_().clamp_(0, 255).to(torch.uint8).unsqueeze(1)
+
 
+def _runs(indices):
+    """昇順のインデックス列を連続区間 (始点, 終点) のリストにまとめる"""
+    if len(indices) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(indices) > 1)
+    starts = np.r_[indices[0], indices[breaks + 1]]
+    ends = np.r_[indices[breaks], indices[-1]]
+    return list(zip(starts.tolist(), ends.tolist()))
 
-def pil_to_tensor(image):
-    """PIL ImageをComfyUIのテンソル形式に変換"""
-    image_np = np.array(image).astype(np.float32) / 255.0
-    if len(image_np.shape) == 2:
-        image_np = np.expand_dims(image_np, axis=2)
-    image_np = np.expand_dims(image_np, axis=0)
-    return torch.from_numpy(image_np)
+
+def kernel_rects(kernel):
+    """
+    構造要素を矩形の和集合に分解する
+    各行の連続区間ごとに、その区間をすべて含む行の範囲を1つの矩形とする
+    （矩形はそのまま1個、十字は縦横の線2本、楕円は幅の異なる帯の重なりになる）
+    戻り値: アンカー（中心）からの広がり (上, 下, 左, 右) のリスト
+    """
+    kernel = np.asarray(kernel) != 0
+    kh, kw = kernel.shape
+    ay, ax = kh // 2, kw // 2
+    segments = set()
+    for row in kernel:
+        segments.update(_runs(np.flatnonzero(row)))
+    rects = set()
+    for c0, c1 in segments:
+        for y0, y1 in _runs(np.flatnonzero(kernel[:, c0:c1 + 1].all(axis=1))):
+            rects.add((y0, y1, c0, c1))
+    # 他の矩形に含まれる矩形は結果に影響しないので除く
+    rects = [r for r in rects if not any(
+        o != r and o[0] <= r[0] and r[1] <= o[1] and o[2] <= r[2] and r[3] <= o[3] for o in rects)]
+    return [(ay - y0, y1 - ay, ax - c0, c1 - ax) for y0, y1, c0, c1 in sorted(rects)]
+
+
+def running_max(x, before, after, dim):
+    """
+    van Herk / Gil-Werman法による1次元の区間最大値
+    out[i] = max(x[i - before], ..., x[i + after])（画像外は無視）
+    窓を長さkのブロックに区切り、ブロック内の前方・後方の累積最大を組み合わせるため、
+    窓の長さによらず1画素あたり定数回の比較で済む
+    """
+    k = before + after + 1
+    if k == 1 and before == 0:
+        return x
+    dim = dim % x.dim()
+    n = x.shape[dim]
+    # 窓がアンカーを含まない（before < 0）場合は出力側の位置をずらす
+    lead = max(before, 0)
+    shift = lead - before
+    blocks = -(-(n + max(lead, shift + k - 1)) // k)
+    pad = [0, 0] * (x.dim() - 1 - dim) + [lead, blocks * k - n - lead]
+    lowest = float("-inf") if x.is_floating_point() else torch.iinfo(x.dtype).min
+    backward = F.pad(x, pad, value=lowest).unflatten(dim, (blocks, k))
+    forward = backward.clone()
+    # ブロック内の位置ごとに全ブロックまとめて累積最大を取る（転置やコピーは不要）
+    for j in range(1, k):
+        f = forward.select(dim + 1, j)
+        torch.maximum(f, forward.select(dim + 1, j - 1), out=f)
+        b = backward.select(dim + 1, k - 1 - j)
+        torch.maximum(b, backward.select(dim + 1, k - j), out=b)
+    forward = forward.flatten(dim, dim + 1)
+    backward = backward.flatten(dim, dim + 1)
+    return torch.maximum(backward.narrow(dim, shift, n), forward.narrow(dim, shift + k - 1, n))
+
+
+def line_max_torch(x, before, after, vertical):
+    """x: [B, 1, H, W] の横（vertical=Trueなら縦）方向の区間最大値"""
+    return running_max(x, before, after, -2 if vertical else -1)
+
+
+def line_max_opencv(x, before, after, vertical):
+    """x: [H, W, C] uint8 の横（vertical=Trueなら縦）方向の区間最大値（1×k / k×1 のカーネルで膨張）"""
+    if before == 0 and after == 0:
+        return x
+    # 窓 [-before, after] と原点を含む長さのカーネルにして、窓の外は0にする
+    lo, hi = min(-before, 0), max(after, 0)
+    line = np.zeros(hi - lo + 1, dtype=np.uint8)
+    line[-before - lo:after - lo + 1] = 1
+    if vertical:
+        out = cv2.dilate(x, line[:, np.newaxis], anchor=(0, -lo))
+    else:
+        out = cv2.dilate(x, line[np.newaxis, :], anchor=(-lo, 0))
+    return out.reshape(x.shape)
+
+
+# OpenCVで構造要素を分解する目安（直接処理の1画素あたりの比較回数と、分解後の全画素走査1回の費用の比）
+OPENCV_DECOMPOSE_COST = 32
+
+# バックエンドごとの (1次元の区間最大値, 要素ごとの最大, 要素ごとの最小)
+MORPHOLOGY_BACKENDS = {
+    "torch": (line_max_torch, torch.maximum, torch.minimum),
+    "opencv": (line_max_opencv, np.maximum, np.minimum),
+}
+
+
+def staircase(rects):
+    """
+    矩形が「幅が狭いものほど上下に長い」入れ子の階段状（矩形・十字・楕円）で、
+    すべてアンカーを含むなら上下の広がりの小さい順に並べて返す（それ以外はNone）
+    """
+    rects = sorted(rects, key=lambda r: (r[0] + r[1], -(r[2] + r[3])))
+    if any(v < 0 for rect in rects for v in rect):
+        return None
+    for (u0, d0, l0, r0), (u1, d1, l1, r1) in zip(rects, rects[1:]):
+        if u1 < u0 or d1 < d0 or l1 > l0 or r1 > r0:
+            return None
+    return rects
+
+
+def dilate(x, kernel, iterations=1, backend="torch"):
+    """
+    膨張（構造要素内の最大値）
+    x: uint8（torchは [B, 1, H, W]、opencvは [H, W, C]）、kernel: get_kernel の戻り値
+    画像外は最小値として扱う（OpenCVの既定の境界処理と同じ）
+    構造要素を矩形に分解し、各矩形を横・縦の1次元区間最大値で処理する
+    """
+    line, maximum, _ = MORPHOLOGY_BACKENDS[backend]
+    rects = kernel_rects(kernel)
+    if len(rects) == 1:
+        # 矩形をN回適用するのは広がりをN倍した矩形1回と等価
+        rects = [tuple(r * iterations for r in rects[0])]
+        iterations = 1
+    if backend == "opencv":
+        if len(rects) == 1 and min(rects[0]) >= 0:
+            # 矩形はOpenCV内部で横・縦の1次元処理に分離されるので1回の呼び出しで済ませる
+            up, down, left, right = rects[0]
+            rect = np.ones((up + down + 1, left + right + 1), dtype=np.uint8)
+            return cv2.dilate(x, rect, anchor=(left, up)).reshape(x.shape)
+        if np.count_nonzero(kernel) < OPENCV_DECOMPOSE_COST * (3 * len(rects) - 1):
+            # 小さな構造要素は分解するより直接処理する方が速い（1次元処理と最大値の合成で約 3 * 矩形数 回の走査）
+            return cv2.dilate(x, kernel, iterations=iterations).reshape(x.shape)
+    steps = staircase(rects)
+    for _ in range(iterations):
+        if steps is None:
+            out = None
+            for up, down, left, right in rects:
+                y = line(line(x, left, right, False), up, down, True)
+                out = y if out is None else maximum(out, y)
+        else:
+            # 1次元の区間最大値は区間の和で合成できるので、細く長い帯から順に
+            # 横は前の帯の結果を差分だけ広げ、縦は差分だけ伸ばしながらまとめる
+            # max_j V_j(H_j(x)) = V_1(max(H_1, V_2-1(max(H_2, ...))))
+            h = line(x, steps[-1][2], steps[-1][3], False)
+            out = h
+            for (u, d, l, r), (u_next, d_next, l_next, r_next) in reversed(list(zip(steps, steps[1:]))):
+                h = line(h, l - l_next, r - r_next, False)
+                out = maximum(h, line(out, u_next - u, d_next - d, True))
+            out = line(out, steps[0][0], steps[0][1], True)
+        x = out
+    return x
+
+
+def erode(x, kernel, iterations=1, backend="torch"):
+    """収縮（構造要素内の最小値、反転した画像の膨張）"""
+    return 255 - dilate(255 - x, kernel, iterations, backend)
+
+
+def morphology(x, operation, kernel, iterations=1, backend="torch"):
+    """
+    モルフォロジー演算を適用（OpenCVのmorphologyExと同じiterationsの意味）
+    x: uint8（torchは [B, 1, H, W]、opencvは [H, W, C]）
+    差を取る演算はuint8の0で飽和させる（OpenCVと同じ）
+    """
+    minimum = MORPHOLOGY_BACKENDS[backend][2]
+
+    def saturate_sub(a, b):
+        return a - minimum(a, b)
+
+    if operation == "close":
+        # クロージング（膨張→収縮）: 小さな穴や切れ目を埋める
+        return erode(dilate(x, kernel, iterations, backend), kernel, iterations, backend)
+    if operation == "open":
+        # オープニング（収縮→膨張）: 小さな突起やノイズを除去
+        return dilate(erode(x, kernel, iterations, backend), kernel, iterations, backend)
+    if operation == "dilate":
+        # 膨張: 白い領域を拡大
+        return dilate(x, kernel, iterations, backend)
+    if operation == "erode":
+        # 収縮: 白い領域を縮小
+        return erode(x, kernel, iterations, backend)
+    if operation == "gradient":
+        # モルフォロジー勾配: エッジ検出
+        return saturate_sub(dilate(x, kernel, iterations, backend), erode(x, kernel, iterations, backend))
+    if operation == "tophat":
+        # トップハット: 明るい小さな領域の抽出
+        return saturate_sub(x, morphology(x, "open", kernel, iterations, backend))
+    if operation == "blackhat":
+        # ブラックハット: 暗い小さな領域の抽出
+        return saturate_sub(morphology(x, "close", kernel, iterations, backend), x)
+    return x
+
+
+# OpenCVで一度に処理するチャンネル（フレーム）数の上限
+OPENCV_MAX_CHANNELS = 128
+
+
+def morphology_opencv(gray, operation, kernel, iterations=1):
+    """
+    OpenCV（CPU）でバッチ全体にモルフォロジー演算を適用
+    gray: [B, 1, H, W] uint8（フレームをチャンネルとして重ね、まとめて処理する）
+    """
+    frames = gray[:, 0].cpu().numpy().transpose(1, 2, 0)
+    result = np.empty_like(frames)
+    for start in range(0, frames.shape[2], OPENCV_MAX_CHANNELS):
+        chunk = np.ascontiguousarray(frames[:, :, start:start + OPENCV_MAX_CHANNELS])
+        result[:, :, start:start + OPENCV_MAX_CHANNELS] = morphology(chunk, operation, kernel, iterations, "opencv")
+    return torch.from_numpy(result.transpose(2, 0, 1)).unsqueeze(1).to(gray.device)
 
 
 def apply_morphology_operations(image, operation_type="close", kernel_size=3, iterations=1, 
@@ -73,38 +282,10 @@ def apply_morphology_operations(image, operation_type="close", kernel_size=3, it
     else:
         gray = image_np
     
-    # カーネル形状の選択
-    if kernel_shape == "rectangle":
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
-    elif kernel_shape == "cross":
-        kernel = cv2.getStructuringElement(cv2.MORPH_CROSS, (kernel_size, kernel_size))
-    else:  # ellipse
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
-    
-    # モルフォロジー演算の適用
-    if operation_type == "close":
-        # クロージング（膨張→収縮）: 小さな穴や切れ目を埋める
-        result = cv2.morphologyEx(gray, cv2.MORPH_CLOSE, kernel, iterations=iterations)
-    elif operation_type == "open":
-        # オープニング（収縮→膨張）: 小さな突起やノイズを除去
-        result = cv2.morphologyEx(gray, cv2.MORPH_OPEN, kernel, iterations=iterations)
-    elif operation_type == "dilate":
-        # 膨張: 白い領域を拡大
-        result = cv2.dilate(gray, kernel, iterations=iterations)
-    elif operation_type == "erode":
-        # 収縮: 白い領域を縮小
-        result = cv2.erode(gray, kernel, iterations=iterations)
-    elif operation_type == "gradient":
-        # モルフォロジー勾配: エッジ検出
-        result = cv2.morphologyEx(gray, cv2.MORPH_GRADIENT, kernel, iterations=iterations)
-    elif operation_type == "tophat":
-        # トップハット: 明るい小さな領域の抽出
-        result = cv2.morphologyEx(gray, cv2.MORPH_TOPHAT, kernel, iterations=iterations)
-    elif operation_type == "blackhat":
-        # ブラックハット: 暗い小さな領域の抽出
-        result = cv2.morphologyEx(gray, cv2.MORPH_BLACKHAT, kernel, iterations=iterations)
-    else:
-        result = gray
+    # 構造要素を1次元の区間最大値に分解して処理
+    kernel = get_kernel(kernel_shape, kernel_size)
+    result = morphology(gray[:, :, np.newaxis], operation_type, kernel, iterations, "opencv")
+    result = np.ascontiguousarray(result[:, :, 0])
     
     # 元の画像がカラーの場合は3チャンネルに戻す
     if len(image_np.shape) == 3:
@@ -215,6 +396,10 @@ class MorphologyNode:
                     "display": "slider",
                     "display_label": "Binary Threshold"
                 }),
+            },
+            "optional": {
+                # auto: GPU上の画像はtorchで一括処理し、CPU上の画像や失敗時はOpenCVで処理
+                "backend": (["auto", "torch", "opencv"],),
             }
         }
     
@@ -226,43 +411,35 @@ class MorphologyNode:
     CATEGORY = "FixableFlow"
     
     def execute(self, image, operation="close", kernel_size=3, iterations=1,
-                kernel_shape="ellipse", binary_threshold=127):
+                kernel_shape="ellipse", binary_threshold=127, backend="auto"):
         """
-        モルフォロジー演算を実行
+        モルフォロジー演算をバッチ全体に実行
         """
-        # 画像をPIL Imageに変換
-        image_pil = tensor_to_pil(image)
+        if backend == "auto" and image.device.type == "cpu":
+            backend = "opencv"
         
-        # モルフォロジー演算を適用
-        result = apply_morphology_operations(
-            image_pil, 
-            operation,
-            kernel_size,
-            iterations,
-            kernel_shape,
-            binary_threshold
-        )
+        # グレースケール化と8bitへの量子化は両方の処理で共通
+        kernel = get_kernel(kernel_shape, kernel_size)
+        gray = to_gray(image)
         
-        # 比較画像を作成
-        comparison = create_comparison_image(image_pil, result)
+        if backend == "opencv":
+            gray = morphology_opencv(gray, operation, kernel, iterations)
+        else:
+            try:
+                gray = morphology(gray, operation, kernel, iterations, "torch")
+            except RuntimeError as e:
+                if backend == "torch":
+                    raise
+                logger.warning("torch morphology failed, falling back to OpenCV: %s", e)
+                gray = morphology_opencv(gray, operation, kernel, iterations)
         
-        # テンソルに変換
-        result_tensor = pil_to_tensor(result)
-        comparison_tensor = pil_to_tensor(comparison)
+        result = gray.squeeze(1).to(image.dtype).div_(255)
+        result = result.unsqueeze(-1).expand(-1, -1, -1, 3).contiguous()
         
-        return (result_tensor, comparison_tensor)
-
-def create_comparison_image(original, processed):
-    """処理前後の比較画像を作成"""
-    width = original.width
-    height = original.height
-    
-    # 左右に並べた比較画像を作成
-    comparison = Image.new(original.mode, (width * 2, height))
-    comparison.paste(original, (0, 0))
-    comparison.paste(processed, (width, 0))
-    
-    return comparison
+        # 比較画像を作成（処理前後を左右に並べる）
+        comparison = torch.cat([image[..., :3].to(result), result], dim=2)
+        
+        return (result, comparison)
 
 # ノードクラスのマッピング
 NODE_CLASS_MAPPINGS = {
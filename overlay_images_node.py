@@ -4,8 +4,7 @@ Overlay Images Node
 """
 
 import torch
-import numpy as np
-from PIL import Image
+import torch.nn.functional as F
 
 
 class OverlayImagesNode:
@@ -32,6 +31,7 @@ class OverlayImagesNode:
         """
         2つの画像を重ね合わせる
         input2をinput1の上に重ねる（アルファブレンディング）
+        バッチ数が異なる場合は片方が1枚ならブロードキャストする
         
         Args:
             input1: 背景画像 (ComfyUI形式: torch.Tensor [B, H, W, C])
@@ -40,54 +40,52 @@ class OverlayImagesNode:
         Returns:
             重ね合わせた画像 (ComfyUI形式)
         """
-        # バッチの最初の画像を取得
-        img1 = input1[0].clone()
-        img2 = input2[0].clone()
+        batch1, batch2 = input1.shape[0], input2.shape[0]
+        if batch1 != batch2 and batch1 != 1 and batch2 != 1:
+            raise ValueError(f"Batch sizes must match or be 1: input1={batch1}, input2={batch2}")
+        batch = max(batch1, batch2)
         
-        # RGBの場合はRGBAに変換（完全不透明のアルファチャンネルを追加）
-        if img1.shape[2] == 3:
-            alpha1 = torch.ones(img1.shape[0], img1.shape[1], 1, dtype=img1.dtype, device=img1.device)
-            img1 = torch.cat([img1, alpha1], dim=2)
+        # 前景は背景と同じデバイス・型で扱う
+        img1 = to_rgba(input1)
+        img2 = to_rgba(input2.to(device=input1.device, dtype=input1.dtype))
         
-        if img2.shape[2] == 3:
-            alpha2 = torch.ones(img2.shape[0], img2.shape[1], 1, dtype=img2.dtype, device=img2.device)
-            img2 = torch.cat([img2, alpha2], dim=2)
+        # 前景は乗算済みアルファで扱う（リサイズ時に透明部分の色が滲み出さないように）
+        alpha2 = img2[..., 3:4]
+        img2 = torch.cat([img2[..., :3] * alpha2, alpha2], dim=-1)
         
-        # サイズを揃える（input1のサイズに合わせる）
-        if img1.shape[:2] != img2.shape[:2]:
-            # テンソルをNumPy配列に変換
-            img2_np = (img2.cpu().numpy() * 255).astype(np.uint8)
-            img2_pil = Image.fromarray(img2_np, mode='RGBA')
-            
-            # リサイズ (height, width)
-            target_size = (img1.shape[1], img1.shape[0])  # (width, height) for PIL
-            img2_pil = img2_pil.resize(target_size, Image.LANCZOS)
-            
-            # テンソルに戻す
-            img2 = torch.from_numpy(np.array(img2_pil).astype(np.float32) / 255.0)
+        # サイズを揃える（input1のサイズに合わせる、デバイス上でアンチエイリアス付きリサイズ）
+        if img1.shape[1:3] != img2.shape[1:3]:
+            img2 = F.interpolate(img2.permute(0, 3, 1, 2), size=img1.shape[1:3],
+                                 mode="bicubic", align_corners=False, antialias=True)
+            img2 = img2.clamp_(0, 1).permute(0, 2, 3, 1)
+            # バイキュービックのオーバーシュートで色がアルファを超えないようにする
+            img2[..., :3] = torch.minimum(img2[..., :3], img2[..., 3:4])
         
-        # アルファブレンディング
-        # result_rgb = img1_rgb * (1 - alpha2) + img2_rgb * alpha2
-        rgb1 = img1[:, :, :3]
-        rgb2 = img2[:, :, :3]
-        alpha2 = img2[:, :, 3:4]  # 前景のアルファチャンネル
+        # 出力バッファ（背景をバッチ数分に展開してコピー）
+        result = img1.expand(batch, -1, -1, -1).contiguous()
+        if result.data_ptr() == input1.data_ptr():
+            result = result.clone()
         
-        # アルファ合成
-        result_rgb = rgb1 * (1 - alpha2) + rgb2 * alpha2
-        
-        # 結果のアルファチャンネルを計算（Porter-Duff合成）
-        alpha1 = img1[:, :, 3:4]
-        result_alpha = alpha2 + alpha1 * (1 - alpha2)
-        
-        # RGBAを結合
-        result = torch.cat([result_rgb, result_alpha], dim=2)
-        
-        # バッチ次元を追加
-        result = result.unsqueeze(0)
+        # アルファ合成（乗算済みの前景をover合成でインプレースに重ねる）
+        # result_rgb = img1_rgb * (1 - alpha2) + img2_rgb_premultiplied
+        # result_alpha = alpha1 + (1 - alpha1) * alpha2（Porter-Duff合成）
+        alpha2 = img2[..., 3:4].expand(batch, -1, -1, -1)
+        result[..., :3].mul_(1 - alpha2).add_(img2[..., :3].expand(batch, -1, -1, -1))
+        result[..., 3:4].lerp_(alpha2.new_ones(()), alpha2)
         
         return (result,)
 
 
+def to_rgba(image):
+    """
+    RGBの場合はRGBAに変換（完全不透明のアルファチャンネルを追加）
+    """
+    if image.shape[-1] == 4:
+        return image
+    alpha = torch.ones((*image.shape[:-1], 1), dtype=image.dtype, device=image.device)
+    return torch.cat([image[..., :3], alpha], dim=-1)
+
+
 # ノードマッピング
 NODE_CLASS_MAPPINGS = {
     "OverlayImagesNode": OverlayImagesNode
@@ -10,8 +10,7 @@ Shadow Extract Node (HSV Version)
 """
 
 import torch
-import numpy as np
-import cv2
+import torch.nn.functional as F
 
 
 class ShadowExtractNode:
@@ -58,6 +57,7 @@ class ShadowExtractNode:
     def extract_shadow(self, shade, base, weight_V=1.0, weight_S=0.5, normalize_factor=40.0):
         """
         shade画像から影の色を抽出してRGBA画像として出力
+        バッチ全体を入力と同じデバイス上で処理する（片方が1枚ならブロードキャスト）
         
         Args:
             shade: 影あり画像（この画像の色を使用）
@@ -67,70 +67,211 @@ class ShadowExtractNode:
             normalize_factor: 正規化係数
         
         Returns:
-            RGBA画像（RGB=shade側の色、Alpha=影の量）
+            RGBA画像（RGB=shade側の色、Alpha=影の量）[B, H, W, 4]
         """
-        from PIL import Image
+        shade_rgb, base_rgb = prepare_pair(shade, base)
         
-        # ワークフローでは接続が逆になっているため、変数を入れ替える
-        # shade パラメータに接続されているのは実際には base（明るい）
-        # base パラメータに接続されているのは実際には shade（暗い）
-        shade_img = shade[0].clone()   # 実際の shade（暗い影付き画像）
-        base_img = base[0].clone()   # 実際の base（明るいフラット画像）
-        
-        # アルファチャンネルを削除
-        if shade_img.shape[2] == 4:
-            shade_img = shade_img[:, :, :3]
-        if base_img.shape[2] == 4:
-            base_img = base_img[:, :, :3]
+        # 影スコアの計算
+        shadow_score = compute_shadow_score(shade_rgb, base_rgb, weight_V, weight_S)
         
-        # サイズを合わせる
-        if shade_img.shape[:2] != base_img.shape[:2]:
-            base_np = (base_img.cpu().numpy() * 255).astype(np.uint8)
-            base_pil = Image.fromarray(base_np)
-            target_size = (shade_img.shape[1], shade_img.shape[0])
-            base_pil = base_pil.resize(target_size, Image.LANCZOS)
-            base_img = torch.from_numpy(np.array(base_pil).astype(np.float32) / 255.0)
+        # アルファチャンネルに変換（0-1の範囲）
+        alpha = (shadow_score / normalize_factor).clamp_(0.0, 1.0)
         
-        # NumPy配列に変換
-        shade_np = (shade_img.cpu().numpy() * 255).astype(np.uint8)
-        base_np = (base_img.cpu().numpy() * 255).astype(np.uint8)
+        # shade側のRGB + 影のアルファでRGBA画像を作成
+        result = torch.cat([shade_rgb, alpha.unsqueeze(-1)], dim=-1)
         
-        # HSV色空間に変換
-        hsv_shade = cv2.cvtColor(shade_np, cv2.COLOR_RGB2HSV).astype(np.float32)
-        hsv_base = cv2.cvtColor(base_np, cv2.COLOR_RGB2HSV).astype(np.float32)
+        return (result,)
+
+
+class ShadowExtractMultiLevelNode:
+    """
+    影スコアを1回だけ計算し、複数段階（1影・2影など）の影レイヤーをまとめて出力するノード
+    """
+    
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "shade": ("IMAGE",),  # 影あり画像
+                "base": ("IMAGE",),   # 影なし画像（フラット）
+                "weight_V": ("FLOAT", {
+                    "default": 1.0,
+                    "min": 0.0,
+                    "max": 5.0,
+                    "step": 0.1,
+                    "display": "slider"
+                }),
+                "weight_S": ("FLOAT", {
+                    "default": 0.5,
+                    "min": 0.0,
+                    "max": 5.0,
+                    "step": 0.1,
+                    "display": "slider"
+                }),
+                "normalize_factor": ("FLOAT", {
+                    "default": 40.0,
+                    "min": 1.0,
+                    "max": 200.0,
+                    "step": 1.0,
+                    "display": "slider"
+                }),
+                "levels": ("INT", {
+                    "default": 2,
+                    "min": 1,
+                    "max": 8,
+                    "step": 1
+                }),
+                "mode": (["threshold", "band"], {
+                    "default": "threshold"
+                }),
+                "thresholds": ("STRING", {
+                    "default": "",
+                    "multiline": False
+                }),
+            },
+        }
+    
+    RETURN_TYPES = ("IMAGE", "MASK")
+    RETURN_NAMES = ("layers", "masks")
+    FUNCTION = "extract_shadow_levels"
+    CATEGORY = "FixableFlow"
+    
+    def extract_shadow_levels(self, shade, base, weight_V=1.0, weight_S=0.5, normalize_factor=40.0,
+                              levels=2, mode="threshold", thresholds=""):
+        """
+        影スコアから複数段階の影レイヤーを作成
         
-        # H, S, Vチャンネルを分離
-        _, S_shade, V_shade = cv2.split(hsv_shade)
-        _, S_base, V_base = cv2.split(hsv_base)
+        Args:
+            shade: 影あり画像（この画像の色を使用）
+            base: 影なし画像（フラット・比較用）
+            weight_V: 明度差の重み
+            weight_S: 彩度差の重み
+            normalize_factor: 正規化係数
+            levels: 段階数（thresholds 指定時はその個数を使用）
+                    影量が飽和して別の閾値を取れない場合、出力される段階数はこれより少なくなることがある
+            mode: threshold = 閾値以上を各段階に含める（1影 ⊇ 2影）
+                  band = 隣り合う閾値の間だけを各段階に含める（重ならない）
+            thresholds: カンマ区切りの閾値（0-1、正規化後の影量）。空なら影量の分位点から自動決定
         
-        # 影の検出
-        # delta_V: baseよりshadeが暗い部分（影で明度が下がっている）
-        delta_V = np.maximum(0.0, V_base - V_shade)
-        # delta_S: shadeの方が彩度が高い部分（影で彩度が上がる場合）
-        delta_S = np.maximum(0.0, S_shade - S_base)
+        Returns:
+            layers: RGBA画像 [levels * B, H, W, 4]（段階ごとにバッチを並べる）
+            masks: 各段階のマスク [levels * B, H, W]
+        """
+        manual_thresholds = parse_thresholds(thresholds)
+        shade_rgb, base_rgb = prepare_pair(shade, base)
         
-        # 影スコアの計算
-        shadow_score = weight_V * delta_V + weight_S * delta_S
+        # 影スコアは1回だけ計算する
+        shadow_score = compute_shadow_score(shade_rgb, base_rgb, weight_V, weight_S)
+        amount = (shadow_score / normalize_factor).clamp_(0.0, 1.0)
         
-        # アルファチャンネルに変換（0-1の範囲）
-        alpha = np.clip(shadow_score / normalize_factor, 0.0, 1.0)
-        alpha = alpha[:, :, np.newaxis]
+        levels_t = manual_thresholds or auto_thresholds(amount, levels)
         
-        # shade側のRGB + 影のアルファでRGBA画像を作成
-        shade_float = shade_img.cpu().numpy()
-        rgba = np.concatenate([shade_float, alpha], axis=2)
+        bounds = torch.tensor(levels_t + [float("inf")], dtype=amount.dtype, device=amount.device)
+        lower = bounds[:-1].view(-1, 1, 1, 1)
+        masks = (amount.unsqueeze(0) >= lower) & (amount.unsqueeze(0) > 0)
+        if mode == "band":
+            masks &= amount.unsqueeze(0) < bounds[1:].view(-1, 1, 1, 1)
+        masks = masks.to(shade_rgb.dtype).flatten(0, 1)
         
-        # テンソルに変換
-        result = torch.from_numpy(rgba.astype(np.float32))
-        result = result.unsqueeze(0)
+        rgb = shade_rgb.repeat(len(levels_t), 1, 1, 1)
+        layers = torch.cat([rgb, masks.unsqueeze(-1)], dim=-1)
         
-        return (result,)
+        return (layers, masks)
+
+
+def parse_thresholds(text):
+    """
+    カンマ区切りの閾値文字列を重複の無い昇順のリストにする（空文字列なら空リスト）
+    """
+    values = []
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        try:
+            value = float(item)
+        except ValueError:
+            value = None
+        if value is None or not 0.0 <= value <= 1.0:
+            raise ValueError(f"Invalid thresholds {text!r}: expected comma-separated numbers between 0 and 1, "
+                             f"got {item.strip()!r}")
+        values.append(value)
+    return sorted(set(values))
+
+
+def auto_thresholds(amount, levels, bins=1024):
+    """
+    影量 (0, 1] のヒストグラム分位点から段階の閾値を決める（バッチ全体で共通）
+    影量が飽和して複数の分位点が同じビンに入った場合は次の画素のあるビンへずらし、
+    それも無ければ段階を減らす（閾値は狭義単調増加で levels 個以下）
+    """
+    shadow = amount[amount > 0]
+    if shadow.numel() == 0:
+        return [(k + 1) / (levels + 1) for k in range(levels)]
+    hist = torch.histc(shadow, bins=bins, min=0.0, max=1.0)
+    cdf = hist.cumsum(0) / hist.sum()
+    quantiles = torch.arange(levels, dtype=cdf.dtype, device=cdf.device) / levels
+    idx = torch.searchsorted(cdf, quantiles, right=True).clamp_(max=bins - 1)
+    # 画素のあるビンの中での位置に直し、前の分位点と同じ位置なら1つ先へずらす（空の段階・同じ段階を作らない）
+    occupied = torch.nonzero(hist).flatten()
+    steps = torch.arange(levels, device=idx.device)
+    pos = torch.searchsorted(occupied, idx)
+    pos = torch.cummax(pos - steps, dim=0).values + steps
+    idx = occupied[pos[pos < occupied.numel()]]
+    # 各分位点を含むビンの下端を閾値にする（そのビンの画素も段階に含める、最初の段階は影のある画素全体）
+    thresholds = idx.to(torch.float64) / bins
+    thresholds[0] = 0.0
+    return thresholds.tolist()
+
+
+def prepare_pair(shade, base):
+    """
+    shade / base のRGBを同じバッチ数・サイズ・デバイスに揃える
+    """
+    batch_shade, batch_base = shade.shape[0], base.shape[0]
+    if batch_shade != batch_base and batch_shade != 1 and batch_base != 1:
+        raise ValueError(f"Batch sizes must match or be 1: shade={batch_shade}, base={batch_base}")
+    batch = max(batch_shade, batch_base)
+    
+    # アルファチャンネルを削除
+    shade_rgb = shade[..., :3]
+    base_rgb = base[..., :3].to(device=shade.device, dtype=shade.dtype)
+    
+    # サイズを合わせる（デバイス上でアンチエイリアス付きリサイズ）
+    if shade_rgb.shape[1:3] != base_rgb.shape[1:3]:
+        base_rgb = F.interpolate(base_rgb.permute(0, 3, 1, 2), size=shade_rgb.shape[1:3],
+                                 mode="bicubic", align_corners=False, antialias=True)
+        base_rgb = base_rgb.clamp_(0, 1).permute(0, 2, 3, 1)
+    
+    return shade_rgb.expand(batch, -1, -1, -1), base_rgb.expand(batch, -1, -1, -1)
+
+
+def saturation_value(rgb):
+    """
+    RGB（0-1）からHSVのSとVを計算（OpenCVの8bit HSVと同じ0-255スケール）
+    V = max(R, G, B), S = (max - min) / max
+    """
+    value = rgb.amax(dim=-1)
+    saturation = (value - rgb.amin(dim=-1)) / value.clamp_min(1e-12)
+    return saturation * 255.0, value * 255.0
+
+
+def compute_shadow_score(shade_rgb, base_rgb, weight_V=1.0, weight_S=0.5):
+    """
+    影スコア [B, H, W]
+    delta_V: baseよりshadeが暗い部分（影で明度が下がっている）
+    delta_S: shadeの方が彩度が高い部分（影で彩度が上がる場合）
+    """
+    S_shade, V_shade = saturation_value(shade_rgb)
+    S_base, V_base = saturation_value(base_rgb)
+    return weight_V * (V_base - V_shade).clamp_min_(0.0) + weight_S * (S_shade - S_base).clamp_min_(0.0)
 
 
 NODE_CLASS_MAPPINGS = {
-    "ShadowExtractNode": ShadowExtractNode
+    "ShadowExtractNode": ShadowExtractNode,
+    "ShadowExtractMultiLevelNode": ShadowExtractMultiLevelNode,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
-    "ShadowExtractNode": "Shadow Extract (HSV)"
+    "ShadowExtractNode": "Shadow Extract (HSV)",
+    "ShadowExtractMultiLevelNode": "Shadow Extract Multi-Level (HSV)",
 }
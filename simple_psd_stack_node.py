@@ -1,17 +1,32 @@
 """
 Simple PSD Layer Stack Node (Frontend PSD Generation)
 3つの画像（base, shade, lineart）を受け取り、前端でPSD生成するためのデータを準備するノード
+サーバー側でPSDを書き出し、ルートからダウンロードすることもできる
 合成画像も返す
 """
 
 import torch
 import numpy as np
 import os
+import io
 import json
+import asyncio
+import threading
+import uuid
+from collections import OrderedDict
 from datetime import datetime
+from urllib.parse import urlencode
 import folder_paths
 from PIL import Image
 
+from .ldivider.ld_psd import PsdWriter
+
+try:
+    from server import PromptServer
+    from aiohttp import web
+except ImportError:
+    PromptServer = None
+
 
 class SimplePSDStackNode:
     """
@@ -31,6 +46,13 @@ class SimplePSDStackNode:
                     "default": "layered",
                     "multiline": False
                 }),
+                "server_psd": ("BOOLEAN", {
+                    "default": False,
+                    "display_label": "Write PSD on Server"
+                }),
+            },
+            "hidden": {
+                "unique_id": "UNIQUE_ID",
             }
         }
 
@@ -40,7 +62,7 @@ class SimplePSDStackNode:
     CATEGORY = "FixableFlow"
     OUTPUT_NODE = True
 
-    def prepare_layers(self, base, shade, lineart, filename_prefix="layered"):
+    def prepare_layers(self, base, shade, lineart, filename_prefix="layered", server_psd=False, unique_id=None):
         """
         3つの画像をレイヤーとして準備し、前端でPSD生成するための情報を保存
 
@@ -49,9 +71,11 @@ class SimplePSDStackNode:
             shade: 影画像（真ん中）
             lineart: 線画（一番上）
             filename_prefix: ファイル名のプレフィックス
+            server_psd: サーバー側でPSDファイルも書き出すか
+            unique_id: ノードID（実行履歴のキー）
 
         Returns:
-            合成画像
+            合成画像（UIにはこの実行のレイヤー情報を返す）
         """
         images_list = [base, shade, lineart]
         layer_names = ["base", "shade", "lineart"]
@@ -68,9 +92,11 @@ class SimplePSDStackNode:
         print(f"Preparing layers for frontend PSD generation, size: {width}x{height}")
         print(f"Layer order: base (bottom) → shade (middle) → lineart (top)")
 
-        # 各レイヤーを一時PNGとして保存
+        # 各レイヤーをuint8配列としてレイヤーストアに保持（PNGへのエンコードは要求時に行う）
         layer_info = []
         composite_layers = []
+        # 同じ秒に複数のノード・実行があっても衝突しないよう、ファイル名はすべてこのキーから作る
+        run_key = f"{filename_prefix}_{timestamp}_{uuid.uuid4().hex[:8]}"
 
         for i, (image_tensor, layer_name) in enumerate(zip(images_list, layer_names)):
             # バッチの最初の画像を取得
@@ -80,46 +106,56 @@ class SimplePSDStackNode:
             img_np = (img.cpu().numpy() * 255.0).clip(0, 255).astype(np.uint8)
             composite_layers.append(img_np)
 
-            # PNGとして保存
-            pil_img = Image.fromarray(img_np)
-            filename = f"{filename_prefix}_{timestamp}_{layer_name}.png"
-            filepath = os.path.join(output_dir, filename)
-            pil_img.save(filepath)
-
             layer_info.append({
                 "name": layer_name,
-                "filename": filename
+                "url": "/fixableflow/simple_psd_stack/layer?" + urlencode({"run": run_key, "name": layer_name})
             })
 
-            print(f"  Layer saved: {filename}")
+        get_layer_store().put(run_key, dict(zip(layer_names, composite_layers)))
+        print(f"  Layers stored: {run_key}")
+
+        # 3つの画像を合成
+        composite = self.composite_images(composite_layers[0], composite_layers[1], composite_layers[2])
+
+        # PNGを経由せず、メモリ上のレイヤーから直接PSDを書き出す
+        psd_filename = None
+        if server_psd:
+            psd_filename = f"{run_key}.psd"
+            write_layers_psd(os.path.join(output_dir, psd_filename), composite_layers, layer_names, composite)
+            print(f"PSD saved: {psd_filename}")
 
         # レイヤー情報をJSONとして保存（前端が読み取る）
-        info_filename = f"{filename_prefix}_{timestamp}_layers.json"
+        info_filename = f"{run_key}_layers.json"
         info_file = os.path.join(output_dir, info_filename)
         with open(info_file, 'w', encoding='utf-8') as f:
             json.dump({
+                "run": run_key,
                 "prefix": filename_prefix,
                 "timestamp": timestamp,
                 "layers": layer_info,
                 "width": int(width),
-                "height": int(height)
+                "height": int(height),
+                "psd": psd_filename
             }, f, indent=2)
 
-        # 最新のinfo fileパスを保存（前端がこのファイルを読んで最新のJSONを見つける）
-        log_path = os.path.join(output_dir, 'simple_psd_stack_info.log')
-        with open(log_path, 'w') as f:
-            f.write(info_filename)
+        # 実行履歴に記録（ノードID・プロンプトIDから前端がこの実行を引けるようにする）
+        run = {
+            "run": run_key,
+            "node_id": str(unique_id) if unique_id is not None else None,
+            "prompt_id": get_prompt_id(),
+            "client_id": get_client_id(),
+            "info": info_filename,
+            "psd": psd_filename,
+        }
+        record_run(output_dir, run)
 
         print(f"Layer info saved: {info_filename}")
         print(f"Frontend can now generate PSD from these layers")
 
-        # 3つの画像を合成
-        composite = self.composite_images(composite_layers[0], composite_layers[1], composite_layers[2])
-
         # ComfyUI形式のテンソルに変換
         composite_tensor = torch.from_numpy(composite.astype(np.float32) / 255.0).unsqueeze(0)
 
-        return (composite_tensor,)
+        return {"ui": {"psd_stack": [run]}, "result": (composite_tensor,)}
 
     def composite_images(self, base, shade, lineart):
         """
@@ -168,6 +204,244 @@ class SimplePSDStackNode:
         return result
 
 
+def write_layers_psd(path, layers, names, composite):
+    """
+    uint8のレイヤー画像（下から順）をPSDとして書き出す
+    アルファの無いレイヤーは不透明として扱う
+    """
+    height, width = composite.shape[:2]
+    writer = PsdWriter(path, width=width, height=height)
+    try:
+        for layer, name in zip(layers, names):
+            if layer.shape[2] == 3:
+                layer = np.concatenate([layer, np.full((height, width, 1), 255, dtype=np.uint8)], axis=2)
+            writer.add_layer(layer, name)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close(composite=composite)
+
+
+RUN_INDEX_FILENAME = "simple_psd_stack_runs.jsonl"
+# 実行履歴は最新のこの件数だけを残す
+RUN_INDEX_MAX_ENTRIES = 256
+_run_index_lock = threading.Lock()
+
+
+def get_prompt_id():
+    server = getattr(PromptServer, "instance", None) if PromptServer is not None else None
+    return getattr(server, "last_prompt_id", None)
+
+
+def get_client_id():
+    # 実行中のプロンプトを送ったクライアント（ComfyUIが実行ごとに設定する）
+    server = getattr(PromptServer, "instance", None) if PromptServer is not None else None
+    return getattr(server, "client_id", None)
+
+
+def record_run(output_dir, run):
+    """実行履歴（JSON Lines）に1件追記する（最新の RUN_INDEX_MAX_ENTRIES 件を超えた分は削除）"""
+    path = os.path.join(output_dir, RUN_INDEX_FILENAME)
+    with _run_index_lock:
+        lines = []
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        lines = lines[-(RUN_INDEX_MAX_ENTRIES - 1):]
+        lines.append(json.dumps(run, ensure_ascii=False) + "\n")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, path)
+
+
+def find_run(output_dir, node_id=None, prompt_id=None, client_id=None):
+    """
+    条件に一致する最新の実行を返す（無ければNone）
+    client_id を指定すると、そのクライアントが実行したものだけを対象にする
+    （同じワークフローを複数のユーザーが実行していても他人の実行を返さない）
+    """
+    path = os.path.join(output_dir, RUN_INDEX_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with _run_index_lock:
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+    for line in reversed(lines):
+        try:
+            run = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if node_id is not None and run.get("node_id") != node_id:
+            continue
+        if prompt_id is not None and run.get("prompt_id") != prompt_id:
+            continue
+        if client_id is not None and run.get("client_id") != client_id:
+            continue
+        return run
+    return None
+
+
+class LayerStore:
+    """
+    実行ごとのレイヤー（uint8配列）を保持するストア
+    directory を指定すると保存時に生の .npy としても書き出す（再起動後も残るよう出力ディレクトリ配下に置く）
+    ディスク上は最新の max_spilled 件を超えた古い実行から削除し、メモリ上には最新の max_runs 件だけを保持する
+    メモリに無い実行は .npy をメモリマップで読み込む
+    """
+
+    def __init__(self, max_runs=4, directory=None, max_spilled=16):
+        self.max_runs = max_runs
+        self.directory = directory
+        self.max_spilled = max_spilled
+        self.runs = OrderedDict()
+        self.spilled = OrderedDict()
+        self.lock = threading.Lock()
+        if directory is not None and os.path.isdir(directory):
+            # 前回までに書き出したファイルも古い順に上限の対象にする
+            files = sorted((entry for entry in os.scandir(directory) if entry.name.endswith(".npy")),
+                           key=lambda entry: entry.stat().st_mtime)
+            for entry in files:
+                self.spilled.setdefault(entry.name.rsplit("_", 1)[0], []).append(entry.path)
+            self._trim_spilled()
+
+    def _path(self, key, name):
+        return os.path.join(self.directory, f"{key}_{name}.npy")
+
+    def _spill(self, key, layers):
+        os.makedirs(self.directory, exist_ok=True)
+        paths = []
+        for name, layer in layers.items():
+            path = self._path(key, name)
+            np.save(path, layer)
+            paths.append(path)
+        self.spilled[key] = paths
+        self._trim_spilled()
+
+    def _trim_spilled(self):
+        while len(self.spilled) > self.max_spilled:
+            _, paths = self.spilled.popitem(last=False)
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def put(self, key, layers):
+        with self.lock:
+            if self.directory is not None:
+                self._spill(key, layers)
+            self.runs[key] = layers
+            self.runs.move_to_end(key)
+            while len(self.runs) > self.max_runs:
+                self.runs.popitem(last=False)
+
+    def get(self, key, names):
+        with self.lock:
+            if key in self.runs:
+                return self.runs[key]
+            if key not in self.spilled:
+                return None
+            paths = {name: self._path(key, name) for name in names}
+            if not all(os.path.exists(path) for path in paths.values()):
+                return None
+            return {name: np.load(path, mmap_mode="r") for name, path in paths.items()}
+
+
+_layer_store = None
+
+
+def get_layer_store():
+    global _layer_store
+    if _layer_store is None:
+        # ComfyUIは起動時に一時ディレクトリを消すので、レイヤーは出力ディレクトリ配下に保存する
+        _layer_store = LayerStore(directory=os.path.join(folder_paths.get_output_directory(), "simple_psd_stack_layers"))
+    return _layer_store
+
+
+def get_run_key(info):
+    # 旧形式のレイヤー情報には run が無いので prefix と timestamp から作る
+    return info.get("run") or f"{info['prefix']}_{info['timestamp']}"
+
+
+def load_run_layers(info, output_dir):
+    """レイヤー情報JSONに対応するレイヤー配列を取得（旧形式のPNGにも対応）"""
+    names = [layer["name"] for layer in info["layers"]]
+    layers = get_layer_store().get(get_run_key(info), names)
+    if layers is None and all("filename" in layer for layer in info["layers"]):
+        layers = {layer["name"]: np.array(Image.open(os.path.join(output_dir, layer["filename"])))
+                  for layer in info["layers"]}
+    return layers
+
+
+def encode_png(layer):
+    # 速度優先の設定でPNGにエンコード
+    buffer = io.BytesIO()
+    Image.fromarray(np.asarray(layer)).save(buffer, format="PNG", compress_level=1, optimize=False)
+    return buffer.getvalue()
+
+
+def build_psd_from_info(info, output_dir):
+    """レイヤー情報JSONからPSDを取得（未作成ならレイヤーストアから書き出す）"""
+    psd_filename = info.get("psd") or f"{get_run_key(info)}.psd"
+    psd_path = os.path.join(output_dir, psd_filename)
+    if not os.path.exists(psd_path):
+        layers = load_run_layers(info, output_dir)
+        if layers is None:
+            return None
+        names = [layer["name"] for layer in info["layers"]]
+        layers = [np.asarray(layers[name]) for name in names]
+        composite = SimplePSDStackNode().composite_images(*layers)
+        write_layers_psd(psd_path, layers, names, composite)
+    return psd_path
+
+
+# PSDをダウンロードさせるルート（ComfyUIサーバー上でのみ登録）
+if PromptServer is not None and getattr(PromptServer, "instance", None) is not None:
+    @PromptServer.instance.routes.get("/fixableflow/simple_psd_stack/psd")
+    async def download_simple_psd_stack(request):
+        info_filename = request.query.get("info", "")
+        output_dir = folder_paths.get_output_directory()
+        info_file = os.path.join(output_dir, info_filename)
+        if os.path.basename(info_filename) != info_filename or not info_filename.endswith("_layers.json") \
+                or not os.path.exists(info_file):
+            return web.Response(status=404, text="Layer info not found")
+
+        with open(info_file, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        loop = asyncio.get_running_loop()
+        psd_path = await loop.run_in_executor(None, build_psd_from_info, info, output_dir)
+        if psd_path is None:
+            return web.Response(status=404, text="Layers not found")
+
+        return web.FileResponse(psd_path, headers={
+            "Content-Disposition": f'attachment; filename="{os.path.basename(psd_path)}"'
+        })
+
+    @PromptServer.instance.routes.get("/fixableflow/simple_psd_stack/runs")
+    async def find_simple_psd_stack_run(request):
+        run = find_run(folder_paths.get_output_directory(),
+                       node_id=request.query.get("node_id"), prompt_id=request.query.get("prompt_id"),
+                       client_id=request.query.get("client_id") or None)
+        if run is None:
+            return web.Response(status=404, text="Run not found")
+        return web.json_response(run)
+
+    @PromptServer.instance.routes.get("/fixableflow/simple_psd_stack/layer")
+    async def view_simple_psd_stack_layer(request):
+        run_key = request.query.get("run", "")
+        name = request.query.get("name", "")
+        if os.path.basename(run_key) != run_key or os.path.basename(name) != name:
+            return web.Response(status=404, text="Layer not found")
+        layers = get_layer_store().get(run_key, [name])
+        if layers is None or name not in layers:
+            return web.Response(status=404, text="Layer not found")
+
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(None, encode_png, layers[name])
+        return web.Response(body=body, content_type="image/png")
+
+
 # ノードマッピング
 NODE_CLASS_MAPPINGS = {
     "SimplePSDStackNode": SimplePSDStackNode
@@ -1,11 +1,8 @@
 import * as esbuild from 'esbuild';
 
-await esbuild.build({
-    entryPoints: ['src/psd-utils.js'],
+const common = {
     bundle: true,
-    outfile: '../web/ag-psd.bundle.js',
     format: 'iife',
-    globalName: 'AgPsd',
     platform: 'browser',
     minify: true,
     sourcemap: false,
@@ -26,6 +23,21 @@ await esbuild.build({
             });
         }
     }]
+};
+
+// Main-thread bundle (window.AgPsd)
+await esbuild.build({
+    ...common,
+    entryPoints: ['src/psd-utils.js'],
+    outfile: '../web/ag-psd.bundle.js',
+    globalName: 'AgPsd'
+});
+
+// Web Worker bundle for building PSDs off the main thread (loads ag-psd.bundle.js at runtime)
+await esbuild.build({
+    ...common,
+    entryPoints: ['src/psd-worker.js'],
+    outfile: '../web/psd-worker.bundle.js'
 });
 
 console.log('Build completed successfully!');
@@ -0,0 +1,71 @@
+/**
+ * PSD builder running in a Web Worker
+ * Layers are fetched in parallel, decoded with createImageBitmap and drawn on
+ * OffscreenCanvas; the finished PSD buffer is transferred back to the page.
+ *
+ * ag-psd is not bundled again here: the worker loads the prebuilt
+ * ag-psd.bundle.js next to it (already cached by the page). Layers are
+ * passed to writePsd as imageData, so ag-psd never needs a DOM canvas.
+ *
+ * message in:  { id, width, height, layers: [{ name, url, blendMode, opacity }] }
+ * message out: { id, buffer } or { id, error }
+ */
+
+async function fetchBitmap(url) {
+    const response = await fetch(url);
+    if (!response.ok) {
+        throw new Error(`Failed to load image: ${url}`);
+    }
+    return createImageBitmap(await response.blob());
+}
+
+async function buildPSD(layers, width, height) {
+    const bitmaps = await Promise.all(layers.map((layer) => fetchBitmap(layer.url)));
+
+    const compositeCanvas = new OffscreenCanvas(width, height);
+    const compositeCtx = compositeCanvas.getContext('2d');
+
+    const psdLayers = bitmaps.map((bitmap, i) => {
+        const layer = layers[i];
+        const layerCanvas = new OffscreenCanvas(width, height);
+        const layerCtx = layerCanvas.getContext('2d');
+        layerCtx.drawImage(bitmap, 0, 0, width, height);
+        compositeCtx.drawImage(bitmap, 0, 0, width, height);
+        bitmap.close();
+
+        return {
+            name: layer.name,
+            imageData: layerCtx.getImageData(0, 0, width, height),
+            left: 0,
+            top: 0,
+            right: width,
+            bottom: height,
+            blendMode: layer.blendMode || 'normal',
+            opacity: layer.opacity !== undefined ? layer.opacity : 1
+        };
+    });
+
+    return self.AgPsd.writePsd({
+        width,
+        height,
+        imageData: compositeCtx.getImageData(0, 0, width, height),
+        children: psdLayers
+    });
+}
+
+// Only start listening inside a worker, so importing this file on the main thread is harmless
+if (typeof WorkerGlobalScope !== 'undefined' && self instanceof WorkerGlobalScope) {
+    // ag-psd.bundle.js publishes itself as window.AgPsd; workers have no window
+    self.window = self;
+    importScripts('ag-psd.bundle.js');
+
+    self.onmessage = async (event) => {
+        const { id, layers, width, height } = event.data;
+        try {
+            const buffer = await buildPSD(layers, width, height);
+            self.postMessage({ id, buffer }, [buffer]);
+        } catch (error) {
+            self.postMessage({ id, error: error.message });
+        }
+    };
+}
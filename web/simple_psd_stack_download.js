@@ -1,9 +1,11 @@
 /**
  * SimplePSDStackNode Frontend PSD Generator
- * Uses ag-psd library to generate PSD files in the browser
+ * Downloads the PSD from the server route when available,
+ * otherwise uses ag-psd library to generate PSD files in the browser
  */
 
 import { app } from "../../scripts/app.js";
+import { api } from "../../scripts/api.js";
 
 // Track if ag-psd bundle is loaded
 let agPsdLoaded = false;
@@ -50,15 +52,66 @@ function loadImage(url) {
     });
 }
 
+// PSD builder worker (null: not created yet, false: unavailable)
+const PSD_WORKER_URL = './extensions/ComfyUI-fixableflow/psd-worker.bundle.js';
+let psdWorker = null;
+let psdJobId = 0;
+const psdJobs = new Map();
+
+function getPsdWorker() {
+    if (psdWorker !== null) return psdWorker;
+
+    if (typeof Worker === 'undefined' || typeof OffscreenCanvas === 'undefined') {
+        psdWorker = false;
+        return psdWorker;
+    }
+
+    psdWorker = new Worker(PSD_WORKER_URL);
+    psdWorker.onmessage = (event) => {
+        const { id, buffer, error } = event.data;
+        const job = psdJobs.get(id);
+        if (!job) return;
+        psdJobs.delete(id);
+        if (error) {
+            job.reject(new Error(error));
+        } else {
+            job.resolve(buffer);
+        }
+    };
+    psdWorker.onerror = (event) => {
+        // e.g. the worker or ag-psd bundle failed to load; stop using the worker
+        event.preventDefault?.();
+        psdWorker.terminate();
+        psdWorker = false;
+        for (const job of psdJobs.values()) {
+            job.reject(new Error("PSD worker failed to start"));
+        }
+        psdJobs.clear();
+    };
+    return psdWorker;
+}
+
 /**
- * Create PSD file from layer information
+ * Build the PSD in the worker; the buffer is transferred back without copying
  */
-async function createPSD(layerInfo) {
-    await ensureAgPsdLoaded();
+function buildPSDInWorker(layers, width, height) {
+    const worker = getPsdWorker();
+    if (!worker) {
+        return Promise.reject(new Error("PSD worker is not available"));
+    }
 
-    const { layers, width, height, prefix, timestamp } = layerInfo;
+    return new Promise((resolve, reject) => {
+        const id = ++psdJobId;
+        psdJobs.set(id, { resolve, reject });
+        worker.postMessage({ id, layers, width, height });
+    });
+}
 
-    console.log(`[SimplePSD] Creating PSD: ${width}x${height}, ${layers.length} layers`);
+/**
+ * Build the PSD on the main thread (fallback)
+ */
+async function buildPSDOnMainThread(layers, width, height) {
+    await ensureAgPsdLoaded();
 
     // Create composite canvas
     const compositeCanvas = document.createElement('canvas');
@@ -66,14 +119,11 @@ async function createPSD(layerInfo) {
     compositeCanvas.height = height;
     const compositeCtx = compositeCanvas.getContext('2d');
 
-    // Process each layer
-    const psdLayers = [];
+    // Load all layers in parallel, then draw them in order
+    const images = await Promise.all(layers.map((layer) => loadImage(layer.url)));
 
-    for (const layer of layers) {
-        const url = `/view?filename=${encodeURIComponent(layer.filename)}&type=output&t=${Date.now()}`;
-        console.log(`[SimplePSD] Loading layer: ${layer.name} from ${layer.filename}`);
-
-        const img = await loadImage(url);
+    const psdLayers = images.map((img, i) => {
+        const layer = layers[i];
 
         // Create layer canvas
         const layerCanvas = document.createElement('canvas');
@@ -85,41 +135,92 @@ async function createPSD(layerInfo) {
         // Also draw to composite
         compositeCtx.drawImage(img, 0, 0, width, height);
 
-        psdLayers.push({
+        return {
             name: layer.name,
             canvas: layerCanvas,
             left: 0,
             top: 0,
             right: width,
             bottom: height,
-            blendMode: layer.blendMode || 'normal',
-            opacity: layer.opacity !== undefined ? layer.opacity : 1
-        });
-    }
+            blendMode: layer.blendMode,
+            opacity: layer.opacity
+        };
+    });
 
-    // Create PSD structure
-    const psd = {
+    // Write PSD using ag-psd
+    return window.AgPsd.writePsd({
         width,
         height,
         canvas: compositeCanvas,
         children: psdLayers
-    };
+    });
+}
 
-    // Write PSD using ag-psd
-    const psdBuffer = window.AgPsd.writePsd(psd);
+/**
+ * Create PSD file from layer information
+ */
+async function createPSD(layerInfo) {
+    const { layers, width, height, prefix, timestamp } = layerInfo;
+    const psdName = `${layerInfo.run || `${prefix}_${timestamp}`}.psd`;
+
+    console.log(`[SimplePSD] Creating PSD: ${width}x${height}, ${layers.length} layers`);
+
+    // Layers are encoded to PNG on request; older runs saved PNGs to the output folder
+    const items = layers.map((layer) => ({
+        name: layer.name,
+        url: layer.url
+            ? `${layer.url}&t=${Date.now()}`
+            : `/view?filename=${encodeURIComponent(layer.filename)}&type=output&t=${Date.now()}`,
+        blendMode: layer.blendMode || 'normal',
+        opacity: layer.opacity !== undefined ? layer.opacity : 1
+    }));
+
+    let psdBuffer;
+    try {
+        psdBuffer = await buildPSDInWorker(items, width, height);
+    } catch (error) {
+        console.warn("[SimplePSD] Building PSD on the main thread:", error.message);
+        psdBuffer = await buildPSDOnMainThread(items, width, height);
+    }
 
     // Trigger download
     const blob = new Blob([psdBuffer], { type: 'application/octet-stream' });
     const url = URL.createObjectURL(blob);
     const a = document.createElement('a');
     a.href = url;
-    a.download = `${prefix}_${timestamp}.psd`;
+    a.download = psdName;
     document.body.appendChild(a);
     a.click();
     document.body.removeChild(a);
     URL.revokeObjectURL(url);
 
-    console.log(`[SimplePSD] PSD downloaded: ${prefix}_${timestamp}.psd`);
+    console.log(`[SimplePSD] PSD downloaded: ${psdName}`);
+}
+
+/**
+ * Download the PSD generated on the server, if the route is available
+ * Returns false so the caller can fall back to browser-side generation
+ */
+async function downloadServerPSD(infoFilename) {
+    const url = `/fixableflow/simple_psd_stack/psd?info=${encodeURIComponent(infoFilename)}`;
+
+    try {
+        // HEAD builds the PSD on the server (if needed) without transferring it
+        const response = await fetch(url, { method: 'HEAD' });
+        if (!response.ok) return false;
+    } catch (e) {
+        return false;
+    }
+
+    const a = document.createElement('a');
+    a.href = url;
+    a.download = '';
+    document.body.appendChild(a);
+    a.click();
+    document.body.removeChild(a);
+
+    console.log(`[SimplePSD] PSD downloaded from server: ${infoFilename}`);
+    return true;
 }
 
 app.registerExtension({
@@ -130,6 +231,16 @@ app.registerExtension({
         if (node.comfyClass === "SimplePSDStackNode") {
             console.log("[SimplePSD] Setting up frontend PSD generator");
 
+            // Remember the run returned in this node's UI output
+            const onExecuted = node.onExecuted;
+            node.onExecuted = function (message) {
+                onExecuted?.apply(this, arguments);
+                const run = message?.psd_stack?.[0];
+                if (run) {
+                    this.psdStackRun = run;
+                }
+            };
+
             // Add download button
             const downloadButton = node.addWidget(
                 "button",
@@ -142,17 +253,32 @@ app.registerExtension({
                         // Show loading state
                         downloadButton.name = "Generating PSD...";
 
-                        // Fetch layer info from log file
-                        const logResponse = await fetch('/view?filename=simple_psd_stack_info.log&type=output&t=' + Date.now());
+                        // Use the run reported by this node's last execution,
+                        // or look it up in the run history (e.g. after a page reload).
+                        // The lookup is limited to this client's runs, so other users
+                        // running the same workflow are not picked up; the client id
+                        // survives a reload of the same tab, not a new tab or browser.
+                        let infoFilename = node.psdStackRun?.info;
+                        if (!infoFilename) {
+                            const query = new URLSearchParams({ node_id: node.id, client_id: api.clientId ?? "", t: Date.now() });
+                            const runResponse = await fetch(`/fixableflow/simple_psd_stack/runs?${query}`);
+                            if (runResponse.ok) {
+                                infoFilename = (await runResponse.json()).info;
+                            }
+                        }
 
-                        if (!logResponse.ok) {
+                        if (!infoFilename) {
                             alert("Please run the workflow first to generate layers.\n\nワークフローを実行してレイヤーを生成してください。");
                             return;
                         }
 
-                        const infoFilename = (await logResponse.text()).trim();
                         console.log("[SimplePSD] Layer info file:", infoFilename);
 
+                        // Prefer the server-side PSD; fall back to generating it in the browser
+                        if (await downloadServerPSD(infoFilename)) {
+                            return;
+                        }
+
                         // Fetch layer info JSON
                         const infoResponse = await fetch(`/view?filename=${encodeURIComponent(infoFilename)}&type=output&t=${Date.now()}`);
 